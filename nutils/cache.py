@@ -23,7 +23,7 @@ The cache module.
 """
 
 from . import types, util
-import os, numpy, functools, inspect, builtins, pathlib, pickle, itertools, hashlib, abc, contextlib, treelog as log
+import os, sys, io, zlib, lzma, bz2, numpy, functools, inspect, builtins, pathlib, pickle, hashlib, abc, contextlib, collections, shutil, tempfile, time, queue, threading, treelog as log
 
 class Wrapper:
   'function decorator that caches results by arguments'
@@ -78,22 +78,524 @@ class WrapperCache:
   def __nutils_hash__(self):
     return hashlib.sha1(b'nutils.cache.WrapperCache\0').digest()
 
+class MemoryCache:
+  '''In-memory cache with a bounded size in bytes.
+
+  Items are stored together with their size, which is typically the size of
+  their pickled representation. When the total size exceeds the maximum, the
+  least recently used items are evicted.'''
+
+  def __init__(self, maxsize):
+    self.maxsize = maxsize
+    self.size = 0
+    self._items = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self._items)
+
+  def __contains__(self, key):
+    return key in self._items
+
+  def __getitem__(self, key):
+    value, size = self._items[key]
+    self._items.move_to_end(key)
+    return value
+
+  def __setitem__(self, key, item):
+    value, size = item
+    if key in self._items:
+      self.size -= self._items.pop(key)[1]
+    if size > self.maxsize:
+      return
+    self._items[key] = value, size
+    self.size += size
+    while self.size > self.maxsize:
+      oldvalue, oldsize = self._items.popitem(last=False)[1]
+      self.size -= oldsize
+
 _cache = util.settable()
+_memcache = util.settable()
+_sizelimit = util.settable()
+_codec = util.settable()
+_writer = util.settable()
+_stats = util.settable()
+
+codecs = dict(
+  zlib=(zlib.compress, zlib.decompress),
+  lzma=(lzma.compress, lzma.decompress),
+  bz2=(bz2.compress, bz2.decompress),
+)
+'''Available compression codecs for the disk cache, by name, as pairs of
+compress and decompress functions that map :class:`bytes` to :class:`bytes`.
+Additional codecs can be registered by adding them to this dictionary.'''
 
-def enable(cachedir: str):
+@contextlib.contextmanager
+def enable(cachedir: str, *, memsize: int = 0, maxsize: int = 0, policy: str = 'lru', codec: str = None, writebehind: int = 0):
   '''
   Enable cacheing and set the cache directory to ``cachedir``.  Affects
   functions decorated with :func:`function` and subclasses of
-  :class:`Recursion`.
+  :class:`Recursion`.  If ``memsize`` is positive, results of :func:`function`
+  are additionally kept in memory up to a total pickled size of ``memsize``
+  bytes, such that repeated calls within the same process skip file access
+  altogether.  The memory holds copies of the values, and every call receives a
+  copy of its own, such that results can be modified in place; immutable arrays
+  are shared rather than copied, and memory mapped arrays are mapped anew.  If
+  ``maxsize`` is positive, the disk usage of ``cachedir`` is limited to
+  ``maxsize`` bytes by evicting entries according to ``policy`` (see
+  :func:`gc`) whenever the limit is exceeded on write.  If ``codec`` is the name of one of the :data:`codecs`,
+  cache files larger than 4 KiB are compressed; in this case numerical arrays
+  are byte shuffled to improve compression, rather than memory mapped.  If
+  ``writebehind`` is positive, cache entries are compressed, written and synced
+  to disk by a background thread, with at most ``writebehind`` entries pending;
+  the file lock of an entry is held until it is written completely.  Pending
+  entries are flushed on exit of the context.
   '''
-  return _cache.sets(pathlib.Path(cachedir))
+  if policy not in _policies:
+    raise ValueError('invalid cache policy {!r}; choose from {}'.format(policy, ', '.join(_policies)))
+  if codec is not None and codec not in codecs:
+    raise ValueError('invalid cache codec {!r}; choose from {}'.format(codec, ', '.join(codecs)))
+  cachedir = pathlib.Path(cachedir)
+  writer = _Writer(writebehind) if writebehind > 0 else None
+  with _cache.sets(cachedir), _codec.sets(codec), \
+       _memcache.sets(MemoryCache(memsize) if memsize > 0 else None), \
+       _sizelimit.sets(_SizeLimit(cachedir, maxsize, policy) if maxsize > 0 else None), \
+       _writer.sets(writer):
+    try:
+      yield
+    finally:
+      if writer is not None:
+        writer.close()
 
+@contextlib.contextmanager
 def disable():
   '''
   Disable cacheing.  Affects functions decorated with :func:`function` and
   subclasses of :class:`Recursion`.
   '''
-  return _cache.sets(None)
+  with _cache.sets(None), _memcache.sets(None), _sizelimit.sets(None), _codec.sets(None), _writer.sets(None):
+    yield
+
+class Statistics:
+  '''Usage statistics of the disk cache for a single function or
+  :class:`Recursion` subclass. Times are in seconds. The time saved is
+  estimated from the computation time recorded when the entry was created.'''
+
+  __slots__ = 'hits', 'misses', 'bytesread', 'byteswritten', 'hashtime', 'loadtime', 'storetime', 'saved'
+
+  def __init__(self):
+    for name in self.__slots__:
+      setattr(self, name, 0)
+
+  def __str__(self):
+    return '{} hits, {} misses, {:,} bytes read, {:,} bytes written; hashing {:.2f}s, loading {:.2f}s, storing {:.2f}s; saved {:.2f}s'.format(
+      self.hits, self.misses, self.bytesread, self.byteswritten, self.hashtime, self.loadtime, self.storetime, self.saved)
+
+@contextlib.contextmanager
+def statistics():
+  '''
+  Collect usage statistics of :func:`function` and :class:`Recursion`, and log
+  a summary on exit. Yields a :class:`dict` that maps the qualified name of
+  every cached function or :class:`Recursion` subclass to its
+  :class:`Statistics`.
+  '''
+  stats = {}
+  with _stats.sets(stats):
+    yield stats
+  if stats:
+    with log.context('cache'):
+      for name, item in sorted(stats.items()):
+        log.info('{}: {}'.format(name, item))
+
+def _getstats(name):
+  stats = _stats.value
+  if stats is None:
+    return Statistics()
+  try:
+    return stats[name]
+  except KeyError:
+    return stats.setdefault(name, Statistics())
+
+# Cache files consist of a header dictionary followed by the payload, pickled
+# separately such that the header can be inspected without loading the
+# payload. The header holds the time it took to compute the payload in seconds
+# under key 'cost', and the total size of the external array files (see below)
+# under key 'blobsize'. If the payload is compressed, the name of the codec is
+# stored under key 'codec'. Files created before the introduction of the header
+# contain only the payload.
+#
+# Arrays of at least `_npythreshold` bytes are not pickled but stored as
+# separate `.npy` files next to the cache file, named after the cache file with
+# a numbered suffix. Upon loading these files are memory mapped copy-on-write,
+# such that large arrays are loaded lazily and without copying, while being
+# writable like the array returned on a miss. Modifications remain private to
+# the returned array and do not affect the file. A `types.frozenarray` is pickled via its base array, so that it is
+# restored as a frozenarray and a plain array as a plain array.
+#
+# If a codec is selected, payloads of at least `_compressthreshold` bytes are
+# compressed. Numerical arrays of at least `_compressthreshold` bytes are
+# then stored inline rather than memory mapped, with their bytes shuffled such
+# that bytes of equal significance are contiguous, which for floating point
+# data typically improves compression considerably.
+
+_npythreshold = 1<<20
+_compressthreshold = 1<<12
+
+class _Pickler(pickle.Pickler):
+
+  def __init__(self, f, path, shuffle):
+    self.path = path
+    self.shuffle = shuffle
+    self.blobsize = 0
+    self._nblobs = 0
+    super().__init__(f)
+
+  def persistent_id(self, obj):
+    if type(obj) is not numpy.ndarray:
+      return None
+    array = obj
+    if self.shuffle:
+      if array.nbytes < _compressthreshold or array.dtype.kind not in 'biufc':
+        return None
+      return 'shuffled', array.dtype.str, array.shape, numpy.ascontiguousarray(array).view(numpy.uint8).reshape(-1, array.dtype.itemsize).T.tobytes()
+    if array.nbytes < _npythreshold or array.dtype.hasobject:
+      return None
+    name = '{}.{}.npy'.format(self.path.name, self._nblobs)
+    self._nblobs += 1
+    # Write to a temporary file that atomically replaces the existing file, if
+    # any, rather than truncating a file that another process may have mapped.
+    with tempfile.NamedTemporaryFile(dir=str(self.path.parent), prefix=name+'.', suffix='.tmp', delete=False) as f:
+      numpy.save(f, array, allow_pickle=False)
+      self.blobsize += f.tell()
+    try:
+      os.replace(f.name, str(self.path.parent/name))
+    except OSError: # the existing file, with identical contents, is in use
+      os.unlink(f.name)
+    return name
+
+class _Unpickler(pickle.Unpickler):
+
+  def __init__(self, f, path):
+    self.path = path
+    super().__init__(f)
+
+  def persistent_load(self, name):
+    if isinstance(name, tuple):
+      shuffled, dtype, shape, data = name
+      dtype = numpy.dtype(dtype)
+      return numpy.frombuffer(data, dtype=numpy.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).reshape(shape)
+    try:
+      array = numpy.load(str(self.path.parent/name), mmap_mode='c', allow_pickle=False)
+    except (OSError, ValueError) as e:
+      raise pickle.UnpicklingError('failed to load array from {}'.format(name)) from e
+    return array.view(numpy.ndarray)
+
+# The memory tier holds copies of results, and every hit receives a copy of its
+# own. Copies are made by pickling rather than `copy.deepcopy`, so that
+# immutable arrays can be shared rather than copied, and arrays that are memory
+# mapped from the cache can be mapped anew rather than read in full.
+
+class _Copier(pickle.Pickler):
+
+  def __init__(self, f, remap):
+    self.remap = remap
+    self.objects = []
+    super().__init__(f)
+
+  def persistent_id(self, obj):
+    if isinstance(obj, types.frozenarray) or type(obj) is numpy.ndarray and _isreadonly(obj):
+      kind = 'shared'
+    elif self.remap and type(obj) is numpy.ndarray and isinstance(obj.base, numpy.memmap) and obj.base.mode == 'c' and obj.__array_interface__ == obj.base.__array_interface__:
+      kind = 'mapped'
+    else:
+      return None
+    self.objects.append(obj)
+    return kind, len(self.objects) - 1
+
+class _Uncopier(pickle.Unpickler):
+
+  def __init__(self, f, objects):
+    self.objects = objects
+    super().__init__(f)
+
+  def persistent_load(self, pid):
+    kind, index = pid
+    obj = self.objects[index]
+    if kind == 'shared':
+      return obj
+    try:
+      array = numpy.load(obj.base.filename, mmap_mode='c', allow_pickle=False)
+    except (OSError, ValueError): # the file was evicted
+      return obj.copy()
+    if array.shape != obj.shape or array.dtype != obj.dtype:
+      return obj.copy()
+    return array.view(numpy.ndarray)
+
+def _isreadonly(array):
+  while isinstance(array, numpy.ndarray):
+    if array.flags.writeable:
+      return False
+    array = array.base
+  return True
+
+def _copy(value, remap):
+  f = io.BytesIO()
+  copier = _Copier(f, remap)
+  copier.dump(value)
+  f.seek(0)
+  return _Uncopier(f, copier.objects).load()
+
+def _pickle(data, path, shuffle):
+  payload = io.BytesIO()
+  pickler = _Pickler(payload, path, shuffle)
+  pickler.dump(data)
+  return payload.getvalue(), pickler.blobsize
+
+def _record(payload, blobsize, cost, codec):
+  header = dict(cost=cost, blobsize=blobsize)
+  if codec is not None and len(payload) >= _compressthreshold:
+    compress, decompress = codecs[codec]
+    payload = compress(payload)
+    header['codec'] = codec
+  header['size'] = len(payload)
+  return pickle.dumps(header) + payload
+
+def _load(f, path):
+  header = pickle.load(f)
+  if not isinstance(header, dict): # For old caches.
+    return {}, header
+  codec = header.get('codec')
+  if codec is not None:
+    if codec not in codecs:
+      raise pickle.UnpicklingError('unknown codec {!r}'.format(codec))
+    compress, decompress = codecs[codec]
+    try:
+      payload = decompress(f.read(header['size']))
+    except Exception as e:
+      raise pickle.UnpicklingError('failed to decompress payload') from e
+    return header, _Unpickler(io.BytesIO(payload), path).load()
+  return header, _Unpickler(f, path).load()
+
+def _loadcost(path):
+  cost = 0.
+  try:
+    with path.open('rb') as f:
+      while True:
+        header = pickle.load(f)
+        if not isinstance(header, dict):
+          break
+        cost += header.get('cost', 0.)
+        if 'size' not in header:
+          break
+        f.seek(header['size'], 1)
+  except (OSError, EOFError, pickle.UnpicklingError, IndexError):
+    pass
+  return cost
+
+_policies = {
+  'lru': lambda entry: entry.mtime, # least recently used first
+  'cost': lambda entry: (entry.cost / max(entry.size, 1), entry.mtime), # least computing time per byte first
+}
+
+_Entry = collections.namedtuple('_Entry', ['name', 'paths', 'size', 'mtime', 'cost'])
+
+def _entries(cachedir, withcost):
+  # Group cache files by name, such that external array files are treated as
+  # part of the cache file that references them.
+  groups = collections.defaultdict(list)
+  for path in cachedir.iterdir():
+    groups[path.name.split('.')[0]].append(path)
+  for name, paths in groups.items():
+    files = [item for path in paths for item in ([path] if path.is_file() else path.iterdir() if path.is_dir() else []) if item.is_file()]
+    stats = [item.stat() for item in files]
+    yield _Entry(name=name, paths=paths,
+      size=builtins.sum(stat.st_size for stat in stats),
+      mtime=max((stat.st_mtime for stat in stats), default=0.),
+      cost=builtins.sum(_loadcost(item) for item in files if item.suffix != '.npy' and item.name not in ('index', 'lock')) if withcost else 0.)
+
+def gc(cachedir: str, maxsize: int = 0, policy: str = 'lru', *, keep=()):
+  '''
+  Report and trim the disk usage of a cache directory.  If the usage exceeds
+  ``maxsize`` bytes, and ``maxsize`` is positive, entries are evicted until
+  the usage no longer exceeds ``maxsize``.  The ``policy`` determines the
+  order of eviction: ``'lru'`` evicts least recently used entries first,
+  ``'cost'`` evicts entries with the lowest computing time per byte first.  An
+  entry is either the result of a :func:`function` call or all iterations of a
+  :class:`Recursion`.  Entries with a name in ``keep`` are never evicted.
+  Returns the remaining disk usage in bytes.
+
+  The garbage collector can also be run from the command line::
+
+      python -m nutils.cache gc CACHEDIR [MAXSIZE [POLICY]]
+  '''
+
+  if policy not in _policies:
+    raise ValueError('invalid cache policy {!r}; choose from {}'.format(policy, ', '.join(_policies)))
+  cachedir = pathlib.Path(cachedir)
+  if not cachedir.is_dir():
+    return 0
+  entries = list(_entries(cachedir, withcost=policy == 'cost' and maxsize > 0))
+  usage = builtins.sum(entry.size for entry in entries)
+  log.info('cache {} holds {} entries totalling {:,} bytes'.format(cachedir, len(entries), usage))
+  if maxsize > 0 and usage > maxsize:
+    nevicted = 0
+    for entry in sorted(entries, key=_policies[policy]):
+      if usage <= maxsize:
+        break
+      if entry.name in keep:
+        continue
+      for path in entry.paths:
+        if path.is_dir():
+          shutil.rmtree(str(path), ignore_errors=True)
+        else:
+          try:
+            path.unlink()
+          except FileNotFoundError:
+            pass
+      usage -= entry.size
+      nevicted += 1
+    log.info('evicted {} entries, {:,} bytes remaining'.format(nevicted, usage))
+  return usage
+
+class _SizeLimit:
+  '''Tracks the disk usage of a cache directory and evicts entries when the
+  usage exceeds the limit. To reduce the number of evictions the usage is
+  trimmed to 90% of the limit.'''
+
+  def __init__(self, cachedir, maxsize, policy):
+    self.cachedir = cachedir
+    self.maxsize = maxsize
+    self.policy = policy
+    self.usage = None
+
+  def add(self, nbytes, keep):
+    if self.usage is None:
+      self.usage = builtins.sum(entry.size for entry in _entries(self.cachedir, withcost=False))
+    else:
+      self.usage += nbytes
+    if self.usage > self.maxsize:
+      with log.context('cache'):
+        self.usage = gc(self.cachedir, int(self.maxsize * .9), self.policy, keep=[keep])
+
+def _stored(nbytes, hkey):
+  if _sizelimit.value is not None:
+    _sizelimit.value.add(nbytes, hkey)
+
+# With write-behind enabled the pickled payload of a cache entry is handed to
+# a `_Writer` thread that compresses the payload and writes and syncs it to
+# disk. Pickling remains in the calling thread, because the returned values
+# may be modified in place after they are returned, as is the case for the
+# iterates of `solver.newton`. Cache files are handed over to the writer
+# including their lock, such that other processes can access an entry only
+# after it is written completely. The byte count of every written entry is
+# passed to a callback in the calling thread, to keep `MemoryCache` and
+# `_SizeLimit` single threaded.
+
+class _Writer:
+  '''Background thread that performs cache writes in order of submission,
+  with at most ``maxsize`` writes pending.'''
+
+  def __init__(self, maxsize):
+    self._queue = queue.Queue(maxsize)
+    self._done = collections.deque()
+    self._closed = False
+    self._thread = threading.Thread(target=self._run, name='nutils.cache.writer', daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      write, callback = self._queue.get()
+      try:
+        if write is None:
+          return
+        self._done.append((callback, write()))
+      except Exception as e:
+        self._done.append((None, e))
+      finally:
+        self._queue.task_done()
+
+  def submit(self, write, callback):
+    self.collect()
+    if self._closed:
+      callback(write())
+    else:
+      self._queue.put((write, callback))
+
+  def collect(self):
+    '''run the callbacks of completed writes in the calling thread'''
+
+    while self._done:
+      callback, result = self._done.popleft()
+      if callback is None:
+        log.warning('failed to write cache entry: {}'.format(result))
+      else:
+        callback(result)
+
+  def flush(self):
+    self._queue.join()
+    self.collect()
+
+  def close(self):
+    if not self._closed:
+      self._closed = True
+      self._queue.put((None, None))
+      self._thread.join()
+      self.collect()
+
+def _submit(writer, write, callback):
+  if writer is None:
+    callback(write())
+  else:
+    writer.submit(write, callback)
+
+def _writefile(f, payload, blobsize, cost, codec, sync):
+  with f:
+    record = _record(payload, blobsize, cost, codec)
+    f.write(record)
+    f.truncate()
+    if sync:
+      f.flush()
+      os.fsync(f.fileno())
+  return len(record) + blobsize
+
+def _appendlog(flock, flog, findex, i, start, payload, blobsize, cost, codec, sync):
+  with flock:
+    record = _record(payload, blobsize, cost, codec)
+    flog.seek(start) # overwrite the remains of an incomplete append, if any
+    flog.write(record)
+    flog.truncate()
+    flog.flush()
+    if sync:
+      os.fsync(flog.fileno())
+    findex.seek(8*i)
+    findex.write(flog.tell().to_bytes(8, 'little'))
+    findex.flush()
+  return len(record) + blobsize
+
+def _readlog(flog, start, end, path):
+  '''read and deserialise a Recursion iteration from the log'''
+
+  flog.seek(start)
+  data = flog.read(end - start)
+  if len(data) != end - start:
+    raise EOFError
+  header, value = _load(io.BytesIO(data), path)
+  return header, value, len(data)
+
+def _readindex(f):
+  '''read end offsets of all complete Recursion iterations'''
+
+  f.seek(0)
+  data = f.read()
+  return numpy.frombuffer(data[:len(data)//8*8], dtype='<u8')
+
+def _parsesize(s):
+  '''parse size in bytes with optional K, M, G or T suffix'''
+
+  s = s.strip().upper().rstrip('B')
+  for i, suffix in enumerate('KMGT', start=1):
+    if s.endswith(suffix):
+      return int(float(s[:-1]) * 1024**i)
+  return int(s)
 
 # Define platform-dependent `_lock_file` function.
 def _lock_file_fallback(f): pass
@@ -178,10 +680,14 @@ def function(func=None, *, version=0):
   func_key = hashlib.sha1('{}.{}:{}'.format(func.__module__, func.__qualname__, version).encode()).digest()
   canonicalize = types.argument_canonicalizer(inspect.signature(func))
 
+  name = '{}.{}'.format(func.__module__, func.__qualname__)
+
   @functools.wraps(func)
   def wrapper(*args, **kwargs):
     if _cache.value is None:
       return func(*args, **kwargs)
+    stats = _getstats(name)
+    t0 = time.perf_counter()
     args, kwargs = canonicalize(*args, **kwargs)
     # Hash the function key and the canonicalized arguments and compute the
     # hexdigest.  This is used to identify cache file `cachefile`.
@@ -191,6 +697,18 @@ def function(func=None, *, version=0):
     for hkv in sorted(hashlib.sha1(k.encode()).digest()+types.nutils_hash(v) for k, v in kwargs.items()):
       h.update(hkv)
     hkey = h.hexdigest()
+    stats.hashtime += time.perf_counter() - t0
+    memcache = _memcache.value
+    if memcache is not None and hkey in memcache:
+      log.debug('[cache.function {}] load from memory'.format(hkey))
+      log_, fail, value, cost = memcache[hkey]
+      stats.hits += 1
+      stats.saved += cost
+      log_.replay()
+      if fail:
+        raise value
+      else:
+        return _copy(value, remap=True)
     cachefile = _cache.value/hkey
     # Open and lock `cachefile`.  Try to read it and, if successful, unlock
     # the file (implicitly by closing the file) and return the value.  If
@@ -201,12 +719,14 @@ def function(func=None, *, version=0):
     # party may have written something to the cache already.
     cachefile.parent.mkdir(parents=True, exist_ok=True)
     cachefile.touch()
-    with cachefile.open('r+b') as f:
+    with contextlib.ExitStack() as stack:
+      f = stack.enter_context(cachefile.open('r+b'))
       log.debug('[cache.function {}] acquiring lock'.format(hkey))
       _lock_file(f)
       log.debug('[cache.function {}] lock acquired'.format(hkey))
+      t0 = time.perf_counter()
       try:
-        data = pickle.load(f)
+        header, data = _load(f, cachefile)
         if len(data) == 2: # For old caches.
           value, log_ = data
           fail = False
@@ -217,6 +737,13 @@ def function(func=None, *, version=0):
         pass
       else:
         log.debug('[cache.function {}] load'.format(hkey))
+        cost = header.get('cost', 0.)
+        stats.hits += 1
+        stats.bytesread += f.tell()
+        stats.loadtime += time.perf_counter() - t0
+        stats.saved += cost
+        if memcache is not None:
+          memcache[hkey] = (log_, fail, value if fail else _copy(value, remap=True), cost), f.tell() + header.get('blobsize', 0)
         log_.replay()
         if fail:
           raise value
@@ -227,6 +754,7 @@ def function(func=None, *, version=0):
       # Disable the cache temporarily to prevent caching subresults *in* `func`.
       log_ = log.RecordLog()
       with disable(), log.add(log_):
+        t0 = time.perf_counter()
         try:
           value = func(*args, **kwargs)
         except Exception as e:
@@ -234,8 +762,22 @@ def function(func=None, *, version=0):
           fail = True
         else:
           fail = False
-      pickle.dump((log_, fail, value), f)
-      log.debug('[cache.function {}] store'.format(hkey))
+        cost = time.perf_counter() - t0
+      stats.misses += 1
+      t0 = time.perf_counter()
+      payload, blobsize = _pickle((log_, fail, value), cachefile, shuffle=_codec.value is not None)
+      memvalue = value if fail or memcache is None else _copy(value, remap=False) # copy now, as the caller may modify value before it is stored
+      def stored(nbytes):
+        log.debug('[cache.function {}] store'.format(hkey))
+        stats.byteswritten += nbytes
+        if memcache is not None:
+          memcache[hkey] = (log_, fail, memvalue, cost), nbytes
+        _stored(nbytes, hkey)
+      # Pass ownership of `f`, and thereby of the lock, to `_writefile`.
+      stack.pop_all()
+      writer = _writer.value
+      _submit(writer, functools.partial(_writefile, f, payload, blobsize, cost, _codec.value, writer is not None), stored)
+      stats.storetime += time.perf_counter() - t0
       if fail:
         raise value
       else:
@@ -340,63 +882,119 @@ class Recursion(types.Immutable, metaclass=_RecursionMeta):
     length = type(self).length
     if _cache.value is None:
       yield from self.resume_index([], 0)
-    else:
-      # The hash of `types.Immutable` uniquely defines this `Recursion`, so use
-      # this to identify the cache directory.  All iterations are stored as
-      # separate files, numbered '0000', '0001', ..., in this directory.
-      hkey = self.__nutils_hash__.hex()
-      cachepath = _cache.value / hkey
-      cachepath.mkdir(exist_ok=True, parents=True)
-      log.debug('[cache.Recursion {}] start iterating'.format(hkey))
+      return
+    # The hash of `types.Immutable` uniquely defines this `Recursion`, so use
+    # this to identify the cache directory.  All iterations are appended to a
+    # single file 'log' in this directory.  The file 'index' holds the end
+    # offsets of all complete iterations as 8 byte little endian integers,
+    # such that resuming requires no more than a seek.  Since iterations are
+    # added to the index only after they are written completely, reading needs
+    # no lock.  Once the cached iterations are exhausted, every new iteration
+    # is computed and appended under a lock on the file 'lock', which is
+    # released before the iteration is yielded.  After acquiring the lock the
+    # index is read again, such that iterations that were appended in the
+    # meantime are loaded rather than recomputed.
+    stats = _getstats('{}.{}'.format(type(self).__module__, type(self).__qualname__))
+    t0 = time.perf_counter()
+    hkey = self.__nutils_hash__.hex()
+    stats.hashtime += time.perf_counter() - t0
+    cachepath = _cache.value / hkey
+    cachepath.mkdir(exist_ok=True, parents=True)
+    for name in 'log', 'index', 'lock':
+      (cachepath/name).touch()
+    log.debug('[cache.Recursion {}] start iterating'.format(hkey))
+    writer = _writer.value
+    codec = _codec.value
+    def lock():
+      f = (cachepath/'lock').open('r+b')
+      log.debug('[cache.Recursion {}.{:04d}] acquiring lock'.format(hkey, i))
+      _lock_file(f)
+      log.debug('[cache.Recursion {}.{:04d}] lock acquired'.format(hkey, i))
+      return f
+    def stored(nbytes):
+      stats.byteswritten += nbytes
+      _stored(nbytes, hkey)
+    with (cachepath/'log').open('r+b') as flog, (cachepath/'index').open('r+b') as findex, contextlib.ExitStack() as stack:
+      if writer is not None: # complete all writes before closing log and index
+        stack.callback(writer.flush)
+      ends = _readindex(findex)
       # The `history` variable is updated while reading from the cache and
       # truncated to the required length.
       history = []
-      # The `exhausted` variable controls if we are reading items from the
-      # cache (`False`) or we are computing values and writing to the cache.
-      # Once `exhausted` is `True` we keep it there, even if at some point
-      # there are cached items available.
-      exhausted = False
-      # The `stop` variable indicates if an exception is raised in `resume`.
-      stop = False
-      for i in itertools.count():
-        cachefile = cachepath/'{:04d}'.format(i)
-        cachefile.touch()
-        with cachefile.open('r+b') as f:
-          log.debug('[cache.Recursion {}.{:04d}] acquiring lock'.format(hkey, i))
-          _lock_file(f)
-          log.debug('[cache.Recursion {}.{:04d}] lock acquired'.format(hkey, i))
-          if not exhausted:
-            try:
-              log_, stop, value = pickle.load(f)
-            except (pickle.UnpicklingError, IndexError):
-              log.debug('[cache.Recursion {}.{:04d}] failed to load, cache will be rewritten from this point'.format(hkey, i))
-              exhausted = True
-            except EOFError:
-              log.debug('[cache.Recursion {}.{:04d}] cache exhausted'.format(hkey, i))
-              exhausted = True
-            else:
-              log.debug('[cache.Recursion {}.{:04d}] load'.format(hkey, i))
-              log_.replay()
-              if stop and value is None:
-                value = StopIteration
-              history.append(value)
-              if len(history) > length:
-                history = history[1:]
-            if exhausted:
-              resume = self.resume_index(history, i)
-              f.seek(0)
-              del history
-          if exhausted:
-            # Disable the cache temporarily to prevent caching subresults *in* `func`.
-            log_ = log.RecordLog()
-            with disable(), log.add(log_):
+      resume = None
+      i = 0
+      while True:
+        if resume is None and i < len(ends):
+          start = int(ends[i-1]) if i else 0
+          t0 = time.perf_counter()
+          try:
+            header, (log_, stop, value), nbytes = _readlog(flog, start, int(ends[i]), cachepath/'{:04d}'.format(i))
+          except (EOFError, pickle.UnpicklingError, IndexError):
+            with lock():
+              ends = _readindex(findex) # the iteration may have been rewritten in the meantime
               try:
-                value = next(resume)
-              except Exception as e:
-                stop = True
-                value = e
-            log.debug('[cache.Recursion {}.{}] store'.format(hkey, i))
-            pickle.dump((log_, stop, value), f)
+                if i >= len(ends):
+                  raise EOFError
+                header, (log_, stop, value), nbytes = _readlog(flog, start, int(ends[i]), cachepath/'{:04d}'.format(i))
+              except (EOFError, pickle.UnpicklingError, IndexError):
+                log.debug('[cache.Recursion {}.{:04d}] failed to load, cache will be rewritten from this point'.format(hkey, i))
+                if i < len(ends):
+                  findex.truncate(8*i)
+                  flog.truncate(start)
+                ends = ends[:i]
+          if i < len(ends):
+            log.debug('[cache.Recursion {}.{:04d}] load'.format(hkey, i))
+            stats.hits += 1
+            stats.bytesread += nbytes
+            stats.loadtime += time.perf_counter() - t0
+            stats.saved += header.get('cost', 0.)
+            log_.replay()
+            if stop and value is None:
+              value = StopIteration
+            history.append(value)
+            if len(history) > length:
+              history = history[1:]
+            i += 1
+            if not stop:
+              yield value
+              continue
+            elif isinstance(value, StopIteration):
+              return
+            else:
+              raise value
+        flock = lock()
+        try:
+          ends = _readindex(findex)
+          if resume is None:
+            if i < len(ends): # iterations were appended in the meantime
+              continue
+            log.debug('[cache.Recursion {}.{:04d}] cache exhausted'.format(hkey, i))
+            resume = self.resume_index(history, i)
+            del history
+          # Disable the cache temporarily to prevent caching subresults *in* `func`.
+          log_ = log.RecordLog()
+          with disable(), log.add(log_):
+            t0 = time.perf_counter()
+            stop = False
+            try:
+              value = next(resume)
+            except Exception as e:
+              stop = True
+              value = e
+            cost = time.perf_counter() - t0
+          stats.misses += 1
+          t0 = time.perf_counter()
+          if i == len(ends): # not appended by a concurrent iteration in the meantime
+            log.debug('[cache.Recursion {}.{:04d}] store'.format(hkey, i))
+            payload, blobsize = _pickle((log_, stop, value), cachepath/'{:04d}'.format(i), shuffle=codec is not None)
+            # Pass ownership of `flock`, and thereby of the lock, to `_appendlog`.
+            _submit(writer, functools.partial(_appendlog, flock, flog, findex, i, int(ends[i-1]) if i else 0, payload, blobsize, cost, codec, writer is not None), stored)
+            flock = None
+        finally:
+          if flock is not None:
+            flock.close()
+        stats.storetime += time.perf_counter() - t0
+        i += 1
         if not stop:
           yield value
         elif isinstance(value, StopIteration):
@@ -418,4 +1016,15 @@ class Recursion(types.Immutable, metaclass=_RecursionMeta):
     '''
     raise NotImplementedError
 
+def _main(args):
+  if len(args) < 2 or len(args) > 4 or args[0] != 'gc':
+    print('USAGE: python -m nutils.cache gc CACHEDIR [MAXSIZE [POLICY]]')
+    return 1
+  with log.set(log.StdoutLog()):
+    gc(args[1], _parsesize(args[2]) if len(args) > 2 else 0, *args[3:])
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(_main(sys.argv[1:]))
+
 # vim:sw=2:sts=2:et
@@ -291,7 +291,14 @@ def setup(scriptname: str,
           outdir: typing.Optional[str] = None,
           cachedir: str = 'cache',
           cache: bool = False,
+          cachememory: int = 0,
+          cachemaxsize: int = 0,
+          cachepolicy: str = 'lru',
+          cachecodec: typing.Optional[str] = None,
+          cachewritebehind: int = 0,
           nprocs: int = 1,
+          threadpolicy: str = 'divide',
+          pinning: bool = False,
           matrix: str = 'auto',
           richoutput: typing.Optional[bool] = None,
           outrooturi: typing.Optional[str] = None,
@@ -328,8 +335,11 @@ def setup(scriptname: str,
        treelog.set(treelog.TeeLog(consolellog, htmllog)), \
        _traceback(richoutput=richoutput, postmortem=pdb, exit=gracefulexit), \
        warnings.via(treelog.warning), \
-       _cache.enable(os.path.join(outdir, cachedir)) if cache else _cache.disable(), \
+       _cache.statistics(), \
+       _cache.enable(os.path.join(outdir, cachedir), memsize=cachememory<<20, maxsize=cachemaxsize<<20, policy=cachepolicy, codec=cachecodec, writebehind=cachewritebehind) if cache else _cache.disable(), \
        _parallel.maxprocs(nprocs), \
+       _parallel.threadpolicy(threadpolicy), \
+       _parallel.pinning(pinning), \
        _matrix.backend(matrix), \
        _signal_handler(signal.SIGINT, functools.partial(_breakpoint, richoutput)):
 
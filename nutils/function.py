@@ -56,11 +56,13 @@ def strictevaluable(value):
 def simplified(value):
   return strictevaluable(value).simplified
 
-asdtype = lambda arg: arg if any(arg is dtype for dtype in (bool, int, float, complex)) else {'f': float, 'i': int, 'b': bool, 'c': complex}[numpy.dtype(arg).kind]
+asdtype = lambda arg: arg if arg is bool or arg is int or arg is float or arg is complex else {'f': float, 'i': int, 'b': bool, 'c': complex}[numpy.dtype(arg).kind]
 asarray = lambda arg: arg if isarray(arg) else Constant(arg) if numeric.isarray(arg) or numpy.asarray(arg).dtype != object else stack(arg, axis=0)
 asarrays = types.tuple[asarray]
 
 def as_canonical_length(value):
+  if value.__class__ is int:
+    return value
   if isarray(value):
     if value.ndim != 0 or value.dtype != int:
       raise ValueError('length should be an `int` or `Array` with zero dimensions and dtype `int`, got {!r}'.format(value))
@@ -73,6 +75,7 @@ def as_canonical_length(value):
     raise ValueError('length should be an `int` or `Array` with zero dimensions and dtype `int`, got {!r}'.format(value))
   return value
 
+as_canonical_length.canonical_type = int
 asshape = types.tuple[as_canonical_length]
 
 class ExpensiveEvaluationWarning(Warning): pass
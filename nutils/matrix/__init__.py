@@ -27,8 +27,9 @@ the ``export`` method.
 """
 
 from  .. import util, sparse, warnings
-import numpy, importlib
+import numpy, importlib, contextlib
 
+from . import _base
 from ._base import Matrix, MatrixError, BackendNotAvailable, ToleranceNotReached
 for cls in Matrix, MatrixError, BackendNotAvailable, ToleranceNotReached:
   cls.__module__ = __name__ # make it appear as if cls was defined here
@@ -68,6 +69,36 @@ def diag(d):
 def eye(n):
   return diag(numpy.ones(n))
 
+@contextlib.contextmanager
+def factorcache(maxsize):
+  '''Context manager that sets the number of preconditioners, such as direct
+  factorizations, that are retained for reuse by subsequent matrices of the
+  same backend with identical sparsity pattern and values. A ``maxsize`` of
+  zero disables reuse, which is the default. The same number of symbolic
+  analyses, such as fill reducing orderings, is retained for reuse by matrices
+  with identical sparsity pattern. Retained preconditioners and analyses in
+  excess of the enclosing setting are released on exit.'''
+
+  try:
+    with _base._factorcachesize.sets(maxsize):
+      yield
+  finally:
+    for store in _base._factorizations, _base._analyses:
+      while len(store) > _base._factorcachesize.value:
+        store.popitem(last=False)
+
+def multigrid(prolongators, nsmooth=2):
+  '''Context manager that defines the refinement hierarchy for the 'multigrid'
+  preconditioner. The prolongators are matrices that express the dofs of a
+  coarse level in terms of those of the next finer level, ordered from the
+  finest level to the coarsest, such as obtained from
+  :meth:`nutils.topology.Topology.prolongation`. The first prolongator
+  matches the unconstrained system; constraints are carried over to the coarse
+  levels. Each level performs ``nsmooth`` damped Jacobi iterations before and
+  after the coarse grid correction, and the coarsest level is solved directly.'''
+
+  return _base._multigrid.sets((tuple(prolongators), nsmooth))
+
 def _import_backend(name):
   return importlib.import_module('._'+name.lower(), __name__)
 
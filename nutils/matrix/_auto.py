@@ -8,4 +8,5 @@ def setassemble(sets):
       from ._scipy import setassemble
     except BackendNotAvailable:
       from ._numpy import setassemble
+      return setassemble(sets, 'csr')
   return setassemble(sets)
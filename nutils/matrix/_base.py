@@ -18,8 +18,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from .. import numeric
-import abc, treelog, functools, numpy, itertools, collections
+from .. import numeric, util, types
+import abc, treelog, functools, numpy, itertools, collections, hashlib, time
 
 class MatrixError(Exception):
   '''
@@ -41,6 +41,103 @@ class ToleranceNotReached(MatrixError):
     super().__init__('solver failed to reach tolerance')
     self.best = best
 
+_factorcachesize = util.settable(0)
+_factorizations = collections.OrderedDict() # (backend, precon, pattern, values) -> preconditioner
+_analyses = collections.OrderedDict() # (backend, name, pattern) -> symbolic analysis
+_multigrid = util.settable(None) # (prolongators, nsmooth)
+_iterations = util.settable(None) # iteration counts reported by solver methods
+
+def _lookup(store, key, maxsize, create):
+  value = store.pop(key, None)
+  while store and len(store) >= maxsize: # evict before creating to limit peak memory
+    store.popitem(last=False)
+  if value is None:
+    value = create()
+  if maxsize:
+    store[key] = value # (re)insert as most recently used
+  return value
+
+def _sparsematmul(adata, arow, acol, bdata, bindices, bindptr, ncols):
+  '''Product of a sparse matrix in coo form with a sparse matrix in csr form,
+  returned in coo form with entries sorted by row and column.'''
+
+  counts = bindptr[acol+1] - bindptr[acol]
+  offsets = numpy.cumsum(counts) - counts
+  positions = numpy.arange(counts.sum()) + numpy.repeat(bindptr[acol] - offsets, counts)
+  keys, inverse = numpy.unique(numpy.repeat(arow, counts) * ncols + bindices[positions], return_inverse=True)
+  data = numpy.bincount(inverse, numpy.repeat(adata, counts) * bdata[positions], minlength=len(keys))
+  row, col = numpy.divmod(keys, ncols)
+  return data, row, col
+
+def _jacobiweights(data, indices, indptr, rho=None):
+  '''Damped jacobi weights 4/(3 rho diag(A)) for a square matrix A in csr
+  form, with rho the spectral radius of inv(diag(A)) A. If rho is not given
+  the Gershgorin bound is used, which unlike an estimate from below
+  guarantees that the smoother is convergent.'''
+
+  n = len(indptr) - 1
+  rows = numpy.repeat(numpy.arange(n), numpy.diff(indptr))
+  ondiag = rows == indices
+  diag = numpy.bincount(rows[ondiag], data[ondiag], minlength=n)
+  if not diag.all():
+    raise MatrixError('multigrid smoother: diagonal has zero entries')
+  if rho is None:
+    rho = (numpy.bincount(rows, abs(data), minlength=n) / abs(diag)).max()
+  return 4 / (3 * rho * diag)
+
+def _vcycle(levels, coarsesolve, nsmooth):
+  '''Symmetric multigrid V-cycle with damped jacobi smoothing. Every level is
+  a tuple of an operator, a prolongator to the next coarser level and jacobi
+  weights; the coarsest level is solved by ``coarsesolve``.'''
+
+  def vcycle(rhs, ilevel=0):
+    if ilevel == len(levels):
+      return coarsesolve(rhs)
+    A, P, weights = levels[ilevel]
+    weights = weights.reshape(weights.shape+(1,)*(rhs.ndim-1))
+    lhs = weights * rhs
+    for i in range(nsmooth-1):
+      lhs += weights * (rhs - A @ lhs)
+    lhs += P @ vcycle(P.T @ (rhs - A @ lhs), ilevel+1)
+    for i in range(nsmooth):
+      lhs += weights * (rhs - A @ lhs)
+    return lhs
+  return vcycle
+
+def _countiterations(niter):
+  '''Report the number of iterations performed by a solver method.'''
+
+  if _iterations.value is not None:
+    _iterations.value.append(niter)
+
+def _columnwise(solver):
+  '''Decorator that extends a solver method for a single right hand side vector
+  to a 2d array of right hand sides with a tolerance per column, which are
+  solved one after the other using the same preconditioner.'''
+
+  @functools.wraps(solver)
+  def wrapped(self, rhs, *, atol, **solverargs):
+    if rhs.ndim == 1:
+      return solver(self, rhs, atol=atol, **solverargs)
+    atol = numpy.broadcast_to(atol, rhs.shape[1:])
+    lhs = numpy.empty(rhs.shape)
+    for i in treelog.iter.fraction('rhs', range(rhs.shape[1])):
+      lhs[:,i] = solver(self, rhs[:,i], atol=atol[i], **solverargs)
+    return lhs
+  return wrapped
+
+def _singleprecision(solve):
+  '''Wrap a solve function of a single precision factorization to accept and
+  return double precision arrays. Every right hand side is scaled to unit
+  maximum norm to avoid underflow of the small residuals that arise in
+  iterative refinement.'''
+
+  def wrapped(rhs):
+    scale = abs(rhs).max(axis=0)
+    scale = numpy.where(scale, scale, 1)
+    return solve((rhs / scale).astype(numpy.float32)).astype(float) * scale
+  return wrapped
+
 class Matrix:
   'matrix base class'
 
@@ -48,6 +145,8 @@ class Matrix:
     assert len(shape) == 2
     self.shape = shape
     self._precon = object()
+    self._fingerprints = None
+    self._embedding = None
 
   def __reduce__(self):
     from . import assemble
@@ -112,8 +211,10 @@ class Matrix:
 
     Args
     ----
-    rhs : :class:`float` vector or :any:`None`
+    rhs : :class:`float` array or :any:`None`
         Right hand side vector. A :any:`None` value implies the zero vector.
+        An array of higher dimension holds a right hand side vector in every
+        column, which are solved for at once.
     lhs0 : class:`float` vector or :any:`None`
         Initial values: compute the solution by solving ``A dx = b - A lhs0``.
         A :any:`None` value implies the zero vector, i.e. solving ``A x = b``
@@ -135,8 +236,9 @@ class Matrix:
         Relative tolerance: see ``atol``.
     atol : :class:`float`
         Absolute tolerance: require that ``|A x - b| <= max(atol, rtol |b|)``
-        after applying constraints and the initial value. In case ``atol`` and
-        ``rtol`` are both zero (the defaults) solve to machine precision.
+        after applying constraints and the initial value, for every right hand
+        side individually. In case ``atol`` and ``rtol`` are both zero (the
+        defaults) solve to machine precision.
         Otherwise fail with :class:`nutils.matrix.ToleranceNotReached` if the
         requirement is not reached.
     **kwargs :
@@ -148,6 +250,21 @@ class Matrix:
         Left hand side vector.
     '''
 
+    return self._solve(rhs, lhs0=lhs0, constrain=constrain, rconstrain=rconstrain, solver=solver, atol=atol, rtol=rtol, **solverargs)[0]
+
+  def solve_withinfo(self, *args, **kwargs):
+    '''
+    Identical to :func:`nutils.matrix.Matrix.solve`, but return the left hand
+    side vector along with an info object that holds the number of iterations
+    performed by the solver, ``niter``, summed over all right hand sides, the
+    wall time of the solver in seconds, ``time``, and the residual norm per
+    right hand side after applying constraints, ``resnorm``.
+    '''
+
+    with treelog.context('solve'):
+      return self._solve(*args, **kwargs)
+
+  def _solve(self, rhs=None, *, lhs0=None, constrain=None, rconstrain=None, solver='direct', atol=0., rtol=0., **solverargs):
     # absent an initial guess and constraints we can directly forward to _solver
     if lhs0 is constrain is rconstrain is None:
       return self._solver(rhs, solver, atol=atol, rtol=rtol, **solverargs)
@@ -178,8 +295,9 @@ class Matrix:
     else:
       assert rconstrain.shape == (nrows,) and constrain.dtype == bool
       I = ~rconstrain
-    lhs[J] += self.submatrix(I, J)._solver((rhs - self @ lhs)[I], solver, atol=atol, rtol=rtol, **solverargs)
-    return lhs
+    dlhs, info = self.submatrix(I, J)._solver((rhs - self @ lhs)[I], solver, atol=atol, rtol=rtol, **solverargs)
+    lhs[J] += dlhs
+    return lhs, info
 
   def solve_leniently(self, *args, **kwargs):
     '''
@@ -207,26 +325,37 @@ class Matrix:
       raise MatrixError('constrained matrix is not square: {}x{}'.format(*self.shape))
     if rhs.shape[0] != self.shape[0]:
       raise MatrixError('right-hand size shape does not match matrix shape')
-    rhsnorm = numpy.linalg.norm(rhs, axis=0).max()
-    atol = max(atol, rtol * rhsnorm)
-    if rhsnorm <= atol:
+    rhsnorm = numpy.linalg.norm(rhs, axis=0)
+    atol = numpy.maximum(atol, rtol * rhsnorm) # tolerance per right hand side
+    active = numpy.greater(rhsnorm, atol)
+    if not active.any():
       treelog.info('skipping solver because initial vector is within tolerance')
-      return numpy.zeros_like(rhs)
+      return numpy.zeros_like(rhs), types.attributes(niter=0, time=0., resnorm=rhsnorm)
     solver_method, solver_name = self._method('solver', solver)
-    treelog.info('solving {} dof system to {} using {} solver'.format(self.shape[0], 'tolerance {:.0e}'.format(atol) if atol else 'machine precision', solver_name))
+    treelog.info('solving {} dof system{} to {} using {} solver'.format(self.shape[0],
+      ' for {} right hand sides'.format(active.sum()) if rhs.ndim > 1 else '',
+      'tolerance {:.0e}'.format(atol.max()) if atol.any() else 'machine precision', solver_name))
+    iterations = []
+    t0 = time.perf_counter()
     try:
-      lhs = solver_method(rhs, atol=atol, **solverargs)
+      with _iterations.sets(iterations):
+        if rhs.ndim == 1:
+          lhs = solver_method(rhs, atol=float(atol), **solverargs)
+        else: # pass only the right hand sides that are not yet within tolerance, as a 2d array
+          lhs = numpy.zeros(rhs.shape)
+          lhs[:,active] = solver_method(rhs[:,active], atol=atol[active], **solverargs)
     except MatrixError:
       raise
     except Exception as e:
       raise MatrixError('solver failed with error: {}'.format(e)) from e
+    info = types.attributes(niter=sum(iterations), time=time.perf_counter()-t0)
     if not numpy.isfinite(lhs).all():
       raise MatrixError('solver returned non-finite left hand side')
-    resnorm = numpy.linalg.norm(rhs - self @ lhs, axis=0).max()
-    treelog.info('solver returned with residual {:.0e}'.format(resnorm))
-    if resnorm > atol > 0:
+    info.resnorm = resnorm = numpy.linalg.norm(rhs - self @ lhs, axis=0)
+    treelog.info('solver returned with residual {:.0e}'.format(resnorm.max()))
+    if (numpy.greater(resnorm, atol) & numpy.greater(atol, 0)).any():
       raise ToleranceNotReached(lhs)
-    return lhs
+    return lhs, info
 
   def _solver_direct(self, rhs, atol, precon='direct', history=0):
     solve = self.getprecon(precon)
@@ -236,12 +365,13 @@ class Matrix:
     c = numpy.multiply(v, rhs, order='F').sum(0) / v2 # min_c |rhs - c v| => c = rhs.v / v.v
     lhs = k * c
     res = rhs - self @ lhs
-    resnorm = numpy.linalg.norm(res, axis=0).max()
-    if not numpy.isfinite(resnorm) or resnorm <= atol:
+    resnorm = numpy.linalg.norm(res, axis=0)
+    if not numpy.isfinite(resnorm).all() or numpy.less_equal(resnorm, atol).all():
       return lhs
     history = collections.deque(maxlen=history)
     with treelog.iter.plain('refinement iteration', itertools.count(start=1)) as count:
       for iiter in count:
+        _countiterations(1)
         history.append((k, v, v2))
         k = solve(res)
         v = self @ k
@@ -254,16 +384,107 @@ class Matrix:
         newlhs = k * c
         newlhs += lhs
         res = rhs - self @ newlhs # recompute rather than update to avoid drift
-        newresnorm = numpy.linalg.norm(res, axis=0).max()
-        if not numpy.isfinite(resnorm) or newresnorm >= resnorm:
-          treelog.debug('residual increased to {:.0e} (discarding)'.format(resnorm))
+        newresnorm = numpy.linalg.norm(res, axis=0)
+        if not numpy.isfinite(newresnorm).all() or newresnorm.max() >= resnorm.max():
+          treelog.debug('residual increased to {:.0e} (discarding)'.format(newresnorm.max()))
           return lhs
         lhs = newlhs
         resnorm = newresnorm
-        treelog.debug('residual decreased to {:.0e}'.format(resnorm))
-        if resnorm <= atol:
+        treelog.debug('residual decreased to {:.0e}'.format(resnorm.max()))
+        if numpy.less_equal(resnorm, atol).all():
           return lhs
 
+  @_columnwise
+  def _solver_cg(self, rhs, atol, precon=None, maxiter=None):
+    '''preconditioned conjugate gradient method for symmetric positive definite matrices'''
+
+    if not atol:
+      raise MatrixError('cg solver requires a nonzero tolerance')
+    if maxiter is None:
+      maxiter = 10 * len(rhs)
+    M = self.getprecon(precon) if precon is not None else numpy.array
+    lhs = numpy.zeros(rhs.shape)
+    res = numpy.array(rhs, dtype=float)
+    z = M(res)
+    p = z.copy()
+    rz = numpy.dot(res, z)
+    resnorm0 = resnorm = numpy.linalg.norm(res)
+    niter = 0
+    with treelog.context('cg {:.0f}%', 0) as format:
+      while resnorm > atol and niter < maxiter:
+        Ap = self @ p
+        alpha = rz / numpy.dot(p, Ap)
+        lhs += alpha * p
+        res -= alpha * Ap
+        resnorm = numpy.linalg.norm(res)
+        if not numpy.isfinite(resnorm):
+          break
+        z = M(res)
+        rz, rzprev = numpy.dot(res, z), rz
+        p *= rz / rzprev
+        p += z
+        niter += 1
+        format(100 * numpy.log(resnorm0/max(resnorm, atol)) / numpy.log(resnorm0/atol))
+    treelog.debug('performed {} cg iterations'.format(niter))
+    _countiterations(niter)
+    return lhs
+
+  @_columnwise
+  def _solver_gmres(self, rhs, atol, precon=None, restart=50, maxiter=None):
+    '''restarted generalized minimal residual method with right preconditioning'''
+
+    if not atol:
+      raise MatrixError('gmres solver requires a nonzero tolerance')
+    if maxiter is None:
+      maxiter = 10 * len(rhs)
+    M = self.getprecon(precon) if precon is not None else numpy.array
+    restart = min(restart, len(rhs))
+    lhs = numpy.zeros(rhs.shape)
+    res = numpy.array(rhs, dtype=float)
+    resnorm0 = resnorm = numpy.linalg.norm(res)
+    niter = 0
+    V = numpy.empty((restart+1, len(rhs)))
+    H = numpy.empty((restart+1, restart))
+    cs = numpy.empty(restart)
+    sn = numpy.empty(restart)
+    g = numpy.empty(restart+1)
+    with treelog.context('gmres {:.0f}%', 0) as format:
+      while resnorm > atol and niter < maxiter:
+        V[0] = res / resnorm
+        g[0] = resnorm
+        for k in range(restart): # arnoldi iteration with modified gram-schmidt
+          w = self @ M(V[k])
+          for j in range(k+1):
+            H[j,k] = numpy.dot(w, V[j])
+            w -= H[j,k] * V[j]
+          H[k+1,k] = numpy.linalg.norm(w)
+          if H[k+1,k]:
+            V[k+1] = w / H[k+1,k]
+          for j in range(k): # apply previous givens rotations to the new column
+            H[j,k], H[j+1,k] = cs[j] * H[j,k] + sn[j] * H[j+1,k], cs[j] * H[j+1,k] - sn[j] * H[j,k]
+          r = numpy.hypot(H[k,k], H[k+1,k])
+          cs[k] = H[k,k] / r
+          sn[k] = H[k+1,k] / r
+          H[k,k] = r
+          g[k+1] = -sn[k] * g[k]
+          g[k] *= cs[k]
+          niter += 1
+          if not abs(g[k+1]) > atol or niter >= maxiter: # the negated comparison includes nan
+            break
+        y = g[:k+1].copy()
+        for j in reversed(range(k+1)): # back substitution
+          y[j] -= numpy.dot(H[j,j+1:k+1], y[j+1:])
+          y[j] /= H[j,j]
+        lhs += M(V[:k+1].T @ y)
+        res = rhs - self @ lhs # recompute rather than update to avoid drift
+        resnorm = numpy.linalg.norm(res)
+        if not numpy.isfinite(resnorm):
+          break
+        format(100 * numpy.log(resnorm0/max(resnorm, atol)) / numpy.log(resnorm0/atol))
+    treelog.debug('performed {} gmres iterations'.format(niter))
+    _countiterations(niter)
+    return lhs
+
   def submatrix(self, rows, cols):
     '''Create submatrix from selected rows, columns.
 
@@ -283,7 +504,14 @@ class Matrix:
     if rows.all() and cols.all():
       return self
 
-    return self._submatrix(rows, cols)
+    submatrix = self._submatrix(rows, cols)
+    if self._embedding is not None: # keep track of the selection relative to the original matrix
+      newrows, newcols = self._embedding[0].copy(), self._embedding[1].copy()
+      newrows[newrows] = rows
+      newcols[newcols] = cols
+      rows, cols = newrows, newcols
+    submatrix._embedding = rows, cols
+    return submatrix
 
   @abc.abstractmethod
   def _submatrix(self, rows, cols):
@@ -314,28 +542,133 @@ class Matrix:
       diag[irow] = data[indptr[irow]+idiag] if idiag < len(icols) and icols[idiag] == irow else 0
     return diag
 
+  @property
+  def fingerprints(self):
+    '''Hashes of the sparsity pattern and of the values of the matrix.
+
+    Matrices of the same backend with equal fingerprints share their
+    preconditioners, see :func:`nutils.matrix.factorcache`.
+    '''
+
+    if self._fingerprints is None:
+      data, indices, indptr = self.export('csr')
+      pattern = hashlib.sha1(numpy.array(self.shape, dtype=numpy.int64))
+      pattern.update(numpy.ascontiguousarray(indices, dtype=numpy.int64))
+      pattern.update(numpy.ascontiguousarray(indptr, dtype=numpy.int64))
+      values = hashlib.sha1(numpy.ascontiguousarray(data))
+      self._fingerprints = pattern.digest(), values.digest()
+    return self._fingerprints
+
   def getprecon(self, precon):
     if precon == self._precon:
       return self._precon_object
     if self.shape[0] != self.shape[1]:
       raise MatrixError('matrix must be square')
     precon_method, precon_name = self._method('precon', precon)
+    if isinstance(precon, str) and _factorcachesize.value > 0:
+      key = (type(self), precon) + self.fingerprints + self._preconcontext()
+      create = functools.partial(self._createprecon, precon_method, precon_name)
+      precon_object = _lookup(_factorizations, key, _factorcachesize.value, create)
+    else:
+      precon_object = self._createprecon(precon_method, precon_name)
+    self._precon = precon
+    self._precon_object = precon_object
+    return precon_object
+
+  def _preconcontext(self):
+    '''Hashable representation of the state outside of the matrix values that
+    preconditioners may depend on: the multigrid hierarchy and the embedding of
+    a submatrix.'''
+
+    multigrid = None
+    if _multigrid.value is not None:
+      prolongators, nsmooth = _multigrid.value
+      multigrid = tuple(P.fingerprints for P in prolongators), nsmooth
+    embedding = None
+    if self._embedding is not None:
+      rows, cols = self._embedding
+      embedding = len(rows), len(cols), hashlib.sha1(numpy.concatenate([rows, cols]).view(numpy.uint8)).digest()
+    return multigrid, embedding
+
+  def _createprecon(self, precon_method, precon_name):
     try:
       with treelog.context('constructing {} preconditioner'.format(precon_name)):
-        precon_object = precon_method()
+        return precon_method()
     except MatrixError:
       raise
     except Exception as e:
       raise MatrixError('failed to create preconditioner: {}'.format(e)) from e
-    self._precon = precon
-    self._precon_object = precon_object
-    return precon_object
+
+  def _getanalysis(self, name):
+    '''Return the symbolic analysis, such as a fill reducing ordering, that
+    was stored under ``name`` via :meth:`_setanalysis` by a matrix of the same
+    backend and sparsity pattern, or None. Analyses are retained only if
+    reuse of preconditioners is enabled via :func:`nutils.matrix.factorcache`,
+    up to the same number.'''
+
+    if _factorcachesize.value == 0:
+      return None
+    key = type(self), name, self.fingerprints[0]
+    analysis = _analyses.get(key)
+    if analysis is not None:
+      _analyses.move_to_end(key)
+    return analysis
+
+  def _setanalysis(self, name, analysis):
+    if _factorcachesize.value == 0:
+      return
+    _analyses[type(self), name, self.fingerprints[0]] = analysis
+    while len(_analyses) > _factorcachesize.value:
+      _analyses.popitem(last=False)
 
   def _precon_diag(self):
     diag = self.diagonal()
     if not diag.all():
       raise MatrixError("building 'diag' preconditioner: diagonal has zero entries")
-    return numpy.reciprocal(diag).__mul__
+    dinv = numpy.reciprocal(diag)
+    return lambda rhs: numpy.multiply(dinv.reshape(dinv.shape + (1,)*(rhs.ndim-1)), rhs) # not a bound __mul__, as numpy may elide the array as a temporary
+
+  def _precon_multigrid(self):
+    if _multigrid.value is None:
+      raise MatrixError("building 'multigrid' preconditioner: no prolongators defined, see nutils.matrix.multigrid")
+    prolongators, nsmooth = _multigrid.value
+    from . import assemble
+    if self._embedding is None:
+      free = numpy.ones(self.shape[0], dtype=bool)
+    elif numpy.equal(*self._embedding).all():
+      free = self._embedding[0]
+    else:
+      raise MatrixError("building 'multigrid' preconditioner: row and column constraints differ")
+    A = self
+    levels = []
+    for P in prolongators:
+      if P.shape[0] != len(free):
+        raise MatrixError("building 'multigrid' preconditioner: prolongator shape {}x{} does not match {} dofs".format(*P.shape, len(free)))
+      # Coarse dofs are retained only if their support lies entirely within
+      # the free fine dofs, such that constraints carry over to all levels.
+      pdata, (prow, pcol) = P.export('coo')
+      keep = numpy.zeros(P.shape[1], dtype=bool)
+      keep[pcol[free[prow]]] = True
+      keep[pcol[~free[prow]]] = False
+      if not keep.any():
+        break
+      select = free[prow] & keep[pcol]
+      pdata, prow, pcol = pdata[select], (numpy.cumsum(free)-1)[prow[select]], (numpy.cumsum(keep)-1)[pcol[select]]
+      n, m = A.shape[0], keep.sum()
+      adata, aindices, aindptr = A.export('csr')
+      arow = numpy.repeat(numpy.arange(n), numpy.diff(aindptr))
+      order = numpy.lexsort([pcol, prow])
+      pindptr = prow[order].searchsorted(numpy.arange(n+1))
+      apdata, aprow, apcol = _sparsematmul(adata, arow, aindices, pdata[order], pcol[order], pindptr, m) # A P
+      apindptr = aprow.searchsorted(numpy.arange(n+1))
+      cdata, crow, ccol = _sparsematmul(pdata, pcol, prow, apdata, apcol, apindptr, m) # P^T A P
+      levels.append((A, assemble(pdata[order], (prow[order], pcol[order]), shape=(n, m)), _jacobiweights(adata, aindices, aindptr)))
+      A = assemble(cdata, (crow, ccol), shape=(m, m))
+      free = keep
+    if not levels:
+      raise MatrixError("building 'multigrid' preconditioner: no coarse dofs")
+    treelog.info('multigrid hierarchy of {} levels: {}'.format(len(levels)+1, ', '.join(str(level[0].shape[0]) for level in levels+[(A,)])))
+    return _vcycle(levels, A.getprecon('direct'), nsmooth)
 
   def __repr__(self):
     return '{}<{}x{}>'.format(type(self).__qualname__, *self.shape)
@@ -18,7 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from ._base import Matrix, MatrixError, BackendNotAvailable
+from ._base import Matrix, MatrixError, BackendNotAvailable, _columnwise, _singleprecision, _countiterations
 from .. import numeric, util, warnings
 from contextlib import contextmanager
 from ctypes import c_long, c_int, c_double, byref
@@ -66,29 +66,32 @@ class Pardiso:
    -12: 'pardiso_64 called from 32-bit library',
   }
 
-  def __init__(self, mtype, a, ia, ja, checkmatrix=False, verbose=False):
+  def __init__(self, mtype, a, ia, ja, perm=None, checkmatrix=False, verbose=False, single=False):
+    self.dtype = numpy.float32 if single else numpy.float64
     self.pt = numpy.zeros(64, numpy.int64) # handle to data structure
     self.maxfct = c_int(1)
     self.mnum = c_int(1)
     self.mtype = c_int(mtype)
     self.n = c_int(len(ia)-1)
-    self.a = a.ctypes
+    self.a = numpy.asarray(a, dtype=self.dtype).ctypes
     self.ia = ia.ctypes
     self.ja = ja.ctypes
-    self.perm = None
+    self.ordering = numpy.empty(len(ia)-1, dtype=numpy.int32) if perm is None else numpy.ascontiguousarray(perm, dtype=numpy.int32)
+    self.perm = self.ordering.ctypes
     self.iparm = numpy.zeros(64, dtype=numpy.int32) # https://software.intel.com/en-us/mkl-developer-reference-c-pardiso-iparm-parameter
     self.msglvl = c_int(verbose)
     libmkl.pardisoinit(self.pt.ctypes, byref(self.mtype), self.iparm.ctypes) # initialize iparm based on mtype
     assert self.iparm[0] == 1, 'pardiso init failed'
+    self.iparm[4] = 2 if perm is None else 1 # return the computed fill-in reducing ordering, or use the supplied one
     self.iparm[26] = checkmatrix
-    self.iparm[27] = 0 # double precision data
+    self.iparm[27] = single # single or double precision data
     self.iparm[34] = 0 # one-based indexing
     self.iparm[36] = 0 # csr matrix format
     self._phase(12) # analysis, numerical factorization
     log.debug('peak memory use {:,d}k'.format(max(self.iparm[14], self.iparm[15]+self.iparm[16])))
 
   def __call__(self, rhs):
-    rhsflat = numpy.ascontiguousarray(rhs.reshape(rhs.shape[0], -1).T, dtype=numpy.float64)
+    rhsflat = numpy.ascontiguousarray(rhs.reshape(rhs.shape[0], -1).T, dtype=self.dtype)
     lhsflat = numpy.empty_like(rhsflat)
     self._phase(33, rhsflat.shape[0], rhsflat.ctypes, lhsflat.ctypes) # solve, iterative refinement
     return lhsflat.T.reshape(rhs.shape)
@@ -214,6 +217,7 @@ class MKLMatrix(Matrix):
       return self.data, (numpy.arange(self.shape[0]).repeat(self.rowptr[1:]-self.rowptr[:-1]), self.colidx-1)
     raise NotImplementedError('cannot export MKLMatrix to {!r}'.format(form))
 
+  @_columnwise
   def _solver_fgmres(self, rhs, atol, maxiter=0, restart=150, precon=None, ztol=1e-12):
     rci = c_int(0)
     n = c_int(len(rhs))
@@ -269,9 +273,21 @@ class MKLMatrix(Matrix):
         else:
           raise MatrixError('this should not have occurred: rci={}'.format(rci.value))
     log.debug('performed {} fgmres iterations, {} restarts'.format(ipar[3], ipar[3]//ipar[14]))
+    _countiterations(int(ipar[3]))
     return b
 
   def _precon_direct(self):
-    return Pardiso(mtype=11, a=self.data, ia=self.rowptr, ja=self.colidx)
+    perm = self._getanalysis('ordering')
+    pardiso = Pardiso(mtype=11, a=self.data, ia=self.rowptr, ja=self.colidx, perm=perm)
+    if perm is None:
+      self._setanalysis('ordering', pardiso.ordering)
+    return pardiso
+
+  def _precon_direct32(self):
+    perm = self._getanalysis('ordering')
+    pardiso = Pardiso(mtype=11, a=self.data, ia=self.rowptr, ja=self.colidx, perm=perm, single=True)
+    if perm is None:
+      self._setanalysis('ordering', pardiso.ordering)
+    return _singleprecision(pardiso)
 
 # vim:sw=2:sts=2:et
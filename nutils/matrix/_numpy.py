@@ -22,8 +22,12 @@ from ._base import Matrix, MatrixError
 from .. import numeric
 import numpy, functools
 
-def setassemble(sets):
-  return sets(assemble)
+def setassemble(sets, form:str='dense'):
+  if form == 'dense':
+    return sets(assemble)
+  if form == 'csr':
+    return sets(assemble_csr)
+  raise MatrixError('invalid numpy matrix form {!r}; choose dense or csr'.format(form))
 
 def assemble(data, index, shape):
   array = numpy.zeros(shape, dtype=data.dtype)
@@ -31,6 +35,9 @@ def assemble(data, index, shape):
     array[tuple(index)] = data
   return NumpyMatrix(array)
 
+def assemble_csr(data, index, shape):
+  return CSRMatrix(data, index[1], index[0].searchsorted(numpy.arange(shape[0]+1)), shape[1])
+
 class NumpyMatrix(Matrix):
   '''matrix based on numpy array'''
 
@@ -93,4 +100,115 @@ class NumpyMatrix(Matrix):
   def _submatrix(self, rows, cols):
     return NumpyMatrix(self.core[numpy.ix_(rows, cols)])
 
+class CSRMatrix(Matrix):
+  '''matrix in compressed sparse row format based on numpy arrays
+
+  Storage and matrix-vector products scale with the number of nonzero entries,
+  rather than with the full size of the matrix. Suited for the iterative 'cg'
+  and 'gmres' solvers; the direct solver falls back to a dense factorization.
+  '''
+
+  def __init__(self, data, indices, indptr, ncols):
+    assert len(data) == len(indices) == indptr[-1]
+    self.data = numpy.ascontiguousarray(data)
+    self.indices = numpy.ascontiguousarray(indices, dtype=int)
+    self.indptr = numpy.ascontiguousarray(indptr, dtype=int)
+    super().__init__((len(indptr)-1, ncols))
+
+  @classmethod
+  def fromcoo(cls, data, row, col, shape):
+    '''create matrix from unsorted coordinates, summing duplicate entries'''
+
+    nrows, ncols = shape
+    flat, inverse = numpy.unique(row * ncols + col, return_inverse=True)
+    if len(flat) < len(data):
+      data = numpy.bincount(inverse, weights=data, minlength=len(flat))
+    else:
+      data, unsorted = numpy.empty_like(data), data
+      data[inverse] = unsorted
+    row, col = divmod(flat, ncols)
+    return cls(data, col, row.searchsorted(numpy.arange(nrows+1)), ncols)
+
+  @property
+  def rows(self):
+    return numpy.repeat(numpy.arange(self.shape[0]), numpy.diff(self.indptr))
+
+  def convert(self, mat):
+    if not isinstance(mat, Matrix):
+      raise TypeError('cannot convert {} to Matrix'.format(type(mat).__name__))
+    if self.shape != mat.shape:
+      raise MatrixError('non-matching shapes')
+    if isinstance(mat, CSRMatrix):
+      return mat
+    return CSRMatrix(*mat.export('csr'), self.shape[1])
+
+  def __add__(self, other):
+    other = self.convert(other)
+    if numpy.equal(self.indptr, other.indptr).all() and numpy.equal(self.indices, other.indices).all():
+      return CSRMatrix(self.data + other.data, self.indices, self.indptr, self.shape[1])
+    return CSRMatrix.fromcoo(numpy.concatenate([self.data, other.data]), numpy.concatenate([self.rows, other.rows]), numpy.concatenate([self.indices, other.indices]), self.shape)
+
+  def __sub__(self, other):
+    return self.__add__(-self.convert(other))
+
+  def __mul__(self, other):
+    if not numeric.isnumber(other):
+      raise TypeError
+    return CSRMatrix(self.data * other, self.indices, self.indptr, self.shape[1])
+
+  def __matmul__(self, other):
+    if not isinstance(other, numpy.ndarray):
+      raise TypeError
+    if other.shape[0] != self.shape[1]:
+      raise MatrixError
+    products = numpy.einsum('i,i...->i...', self.data, other[self.indices])
+    retval = numpy.zeros((self.shape[0],)+products.shape[1:], dtype=products.dtype)
+    nonempty = self.indptr[:-1] < self.indptr[1:]
+    if nonempty.any(): # reduceat misbehaves on empty segments so we skip these
+      retval[nonempty] = numpy.add.reduceat(products, self.indptr[:-1][nonempty], axis=0)
+    return retval
+
+  def __neg__(self):
+    return CSRMatrix(-self.data, self.indices, self.indptr, self.shape[1])
+
+  @property
+  def T(self):
+    return CSRMatrix.fromcoo(self.data, self.indices, self.rows, self.shape[::-1])
+
+  def export(self, form):
+    if form == 'dense':
+      array = numpy.zeros(self.shape, dtype=self.data.dtype)
+      array[self.rows, self.indices] = self.data
+      return array
+    if form == 'coo':
+      return self.data, (self.rows, self.indices)
+    if form == 'csr':
+      return self.data, self.indices, self.indptr
+    raise NotImplementedError('cannot export CSRMatrix to {!r}'.format(form))
+
+  def rowsupp(self, tol=0):
+    supp = numpy.zeros(self.shape[0], dtype=bool)
+    supp[self.rows[abs(self.data) > tol]] = True
+    return supp
+
+  def diagonal(self):
+    nrows, ncols = self.shape
+    if nrows != ncols:
+      raise MatrixError('failed to extract diagonal: matrix is not square')
+    rows = self.rows
+    mask = numpy.equal(rows, self.indices)
+    diag = numpy.zeros(nrows, dtype=self.data.dtype)
+    diag[rows[mask]] = self.data[mask]
+    return diag
+
+  def _submatrix(self, rows, cols):
+    irows = self.rows
+    keep = numpy.logical_and(rows[irows], cols[self.indices])
+    newrows = numpy.cumsum(rows) - 1
+    newcols = numpy.cumsum(cols) - 1
+    return CSRMatrix(self.data[keep], newcols[self.indices[keep]], newrows[irows[keep]].searchsorted(numpy.arange(rows.sum()+1)), cols.sum())
+
+  def _precon_direct(self):
+    return functools.partial(numpy.linalg.solve, self.export('dense'))
+
 # vim:sw=2:sts=2:et
@@ -18,15 +18,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from ._base import Matrix, MatrixError, BackendNotAvailable
+from ._base import Matrix, MatrixError, BackendNotAvailable, _jacobiweights, _vcycle, _columnwise, _singleprecision, _countiterations
 from .. import numeric
 import treelog as log
-import numpy
+import numpy, inspect
 try:
   import scipy.sparse.linalg
 except ImportError:
   raise BackendNotAvailable('the Scipy matrix backend requires scipy to be installed (try: pip install scipy)')
 
+methods = 'bicg', 'bicgstab', 'cg', 'cgs', 'gmres', 'lgmres', 'minres' # iterative solvers of scipy.sparse.linalg
+_gmrescallbacktype = 'callback_type' in inspect.signature(scipy.sparse.linalg.gmres).parameters # scipy>=1.1
+
 def setassemble(sets):
   return sets(assemble)
 
@@ -85,27 +88,50 @@ class ScipyMatrix(Matrix):
   def T(self):
     return ScipyMatrix(self.core.transpose())
 
+  @property
+  def linearoperator(self):
+    return scipy.sparse.linalg.aslinearoperator(self.core)
+
   def _solver(self, rhs, solver, **kwargs):
-    if solver in ['bicg', 'bicgstab', 'cg', 'cgs', 'gmres', 'lgmres', 'minres']:
+    if solver in methods:
       kwargs['method'] = solver
       solver = 'scipy'
     return super()._solver(rhs, solver, **kwargs)
 
-  def _solver_scipy(self, rhs, method, atol, callback=None, precon=None, **solverargs):
+  @_columnwise
+  def _solver_scipy(self, rhs, method, atol, callback=None, precon=None, monitor=10, **solverargs):
+    '''scipy's iterative solvers
+
+    Progress is monitored by the residual norm, which gmres provides at no
+    cost. For the other solvers, which provide the left hand side vector, it
+    is computed every ``monitor`` iterations only, or every iteration if a
+    ``callback`` is given that receives the residual norm.'''
+
     rhsnorm = numpy.linalg.norm(rhs)
     solverfun = getattr(scipy.sparse.linalg, method)
     myrhs = rhs / rhsnorm # normalize right hand side vector for best control over scipy's stopping criterion
     mytol = atol / rhsnorm
     if precon is not None:
       precon = scipy.sparse.linalg.LinearOperator(self.shape, self.getprecon(precon), dtype=float)
+    if method == 'gmres' and _gmrescallbacktype:
+      solverargs.setdefault('callback_type', 'legacy') # residual norm per inner iteration, the only behaviour of scipy<1.1
+    niter = 0
     with log.context(method + ' {:.0f}%', 0) as reformat:
       def mycallback(arg):
-        # some solvers provide the residual, others the left hand side vector
-        res = numpy.linalg.norm(myrhs - self @ arg) if numpy.ndim(arg) == 1 else float(arg)
+        nonlocal niter
+        niter += 1
+        if numpy.ndim(arg) == 0: # the solver provides the residual norm
+          res = float(arg)
+        elif callback or monitor and niter % monitor == 0: # the solver provides the left hand side vector
+          res = numpy.linalg.norm(myrhs - self @ arg)
+        else:
+          return
         if callback:
           callback(res)
         reformat(100 * numpy.log10(max(mytol, res)) / numpy.log10(mytol))
-      mylhs, status = solverfun(self.core, myrhs, M=precon, tol=mytol, callback=mycallback, **solverargs)
+      mylhs, status = solverfun(self.linearoperator, myrhs, M=precon, tol=mytol, callback=mycallback, **solverargs)
+    log.debug('performed {} {} iterations'.format(niter, method))
+    _countiterations(niter)
     if status != 0:
       raise Exception('status {}'.format(status))
     return mylhs * rhsnorm
@@ -113,16 +139,76 @@ class ScipyMatrix(Matrix):
   def _precon_direct(self):
     return scipy.sparse.linalg.factorized(self.core.tocsc())
 
+  def _precon_direct32(self):
+    return _singleprecision(scipy.sparse.linalg.splu(self.core.tocsc().astype(numpy.float32)).solve)
+
   def _precon_splu(self):
     return scipy.sparse.linalg.splu(self.core.tocsc()).solve
 
   def _precon_spilu(self, **kwargs):
     return scipy.sparse.linalg.spilu(self.core.tocsc(), **kwargs).solve
 
+  def _precon_amg(self, theta=.08, coarsesize=500, nsmooth=2):
+    '''smoothed aggregation algebraic multigrid
+
+    The aggregates depend only on the sparsity pattern and, if enabled via
+    :func:`nutils.matrix.factorcache`, are reused by subsequent matrices with
+    the same pattern, in which case only the smoothed prolongators and coarse
+    grid operators are recomputed.'''
+
+    analysis = self._getanalysis('amg')
+    aggregates = []
+    levels = []
+    A = self.core.tocsr()
+    while len(levels) < len(analysis) if analysis is not None else A.shape[0] > coarsesize:
+      aggregate = analysis[len(levels)] if analysis is not None else _aggregate(A, theta)
+      n = A.shape[0]
+      m = aggregate.max() + 1
+      if m == n:
+        break
+      T = scipy.sparse.csr_matrix((numpy.bincount(aggregate)[aggregate]**-.5, aggregate, numpy.arange(n+1)), shape=(n, m)) # tentative prolongator
+      DinvA = scipy.sparse.diags(numpy.reciprocal(A.diagonal())) @ A
+      rho = abs(scipy.sparse.linalg.eigs(DinvA, k=1, tol=1e-2, v0=numpy.random.RandomState(0).uniform(size=n), return_eigenvectors=False)[0])
+      weights = _jacobiweights(A.data, A.indices, A.indptr, rho=1.05*rho) # margin as the estimate converges from below
+      P = (T - scipy.sparse.diags(weights) @ (A @ T)).tocsr() # smoothed prolongator
+      levels.append((A, P, weights))
+      aggregates.append(aggregate)
+      A = (P.T @ A @ P).tocsr()
+    if analysis is None:
+      self._setanalysis('amg', aggregates)
+    log.info('amg hierarchy of {} levels: {}'.format(len(levels)+1, ', '.join(str(level[0].shape[0]) for level in levels+[(A,)])))
+    return _vcycle(levels, scipy.sparse.linalg.splu(A.tocsc()).solve, nsmooth)
+
   def _submatrix(self, rows, cols):
     return ScipyMatrix(self.core[rows,:][:,cols])
 
   def diagonal(self):
     return self.core.diagonal()
 
+def _aggregate(A, theta):
+  '''Assign every row of square csr matrix ``A`` to an aggregate. The aggregates
+  are formed around a maximal independent set of distance two in the graph of
+  strong connections, ``|A_ij| >= theta sqrt(|A_ii A_jj|)``.'''
+
+  n = A.shape[0]
+  coo = A.tocoo()
+  diag = abs(A.diagonal())
+  strong = abs(coo.data) >= theta * numpy.sqrt(diag[coo.row] * diag[coo.col])
+  row = numpy.concatenate([coo.row[strong], coo.col[strong], numpy.arange(n)])
+  col = numpy.concatenate([coo.col[strong], coo.row[strong], numpy.arange(n)])
+  S = scipy.sparse.csr_matrix((numpy.ones(len(row)), (row, col)), shape=(n, n)) # symmetric, with nonempty rows
+  rowmax = lambda v: numpy.maximum.reduceat(v[S.indices], S.indptr[:-1])
+  priority = (numpy.random.RandomState(0).permutation(n) + 1) / n # distinct
+  undecided = numpy.ones(n, dtype=bool)
+  root = numpy.zeros(n, dtype=bool)
+  while undecided.any():
+    newroot = undecided & (priority == rowmax(rowmax(numpy.where(undecided, priority, 0))))
+    root |= newroot
+    undecided &= S @ (S @ newroot) == 0
+  aggregate = numpy.where(root, numpy.cumsum(root)-1, -1)
+  for i in range(2): # join neighbours at distance one and two
+    aggregate = numpy.where(aggregate < 0, rowmax(aggregate), aggregate)
+  assert (aggregate >= 0).all()
+  return aggregate
+
 # vim:sw=2:sts=2:et
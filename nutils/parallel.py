@@ -26,9 +26,14 @@ will disable and a warning is printed.
 """
 
 from . import numeric, warnings, util
-import os, multiprocessing, mmap, signal, contextlib, builtins, numpy, treelog
+import os, sys, multiprocessing, mmap, signal, contextlib, builtins, ctypes, time, pickle, traceback, numpy, treelog
 
 _maxprocs = util.settable(1)
+_threadpolicy = util.settable('divide')
+_pinning = util.settable(False)
+_item = util.settable() # item that is currently being processed by ctxrange
+_errbufsize = 1<<16 # size of the shared buffer for child exceptions per process
+_threadpoolcache = None, () # number of imported modules at discovery, getter-setter pairs
 
 @util.positional_only
 def maxprocs(new: int):
@@ -38,6 +43,34 @@ def maxprocs(new: int):
     raise ValueError('nprocs requires a positive integer argument')
   return _maxprocs.sets(new)
 
+@util.positional_only
+def threadpolicy(new: str):
+  '''set policy for native thread pools in forked processes.
+
+  The thread pools of the BLAS library that numpy links against, and of Intel
+  MKL if loaded, are by default inherited by forked processes, which leads to
+  oversubscription of the available cores. The ``'inherit'`` policy leaves the
+  thread pools untouched; ``'single'`` limits every process to a single thread;
+  ``'divide'`` distributes the available cores evenly over all processes.
+  '''
+
+  if new not in ('inherit', 'single', 'divide'):
+    raise ValueError('threadpolicy requires one of inherit, single, divide')
+  return _threadpolicy.sets(new)
+
+@util.positional_only
+def pinning(new: bool):
+  '''pin forked processes to disjoint sets of cores.
+
+  If enabled, the cores available to the main process are divided in
+  consecutive, evenly sized sets, and every process of a fork is bound to one
+  set. On multi-socket machines this prevents processes from migrating between
+  sockets, such that memory that is first touched by a process remains local.
+  Pinning is silently ignored on platforms that do not support it.
+  '''
+
+  return _pinning.sets(bool(new))
+
 @contextlib.contextmanager
 def fork(nprocs=None):
   '''continue as ``nprocs`` parallel processes by forking ``nprocs-1`` times
@@ -46,6 +79,11 @@ def fork(nprocs=None):
   capped. It is up to the user to prepare shared memory and/or locks for
   inter-process communication. As a safety measure nested forks are blocked by
   limiting nprocs to 1; all secondary forks will be silently ignored.
+
+  If an exception is raised in a child process, it is passed to the main
+  process via shared memory and raised there, with the traceback of the child
+  process as its cause. If the exception cannot be pickled, a generic
+  exception that marks the failure of the fork is raised instead.
   '''
 
   if nprocs is None or nprocs > _maxprocs.value:
@@ -58,6 +96,8 @@ def fork(nprocs=None):
     yield 0
     return
   amchild = False
+  nthreads = _nthreads(nprocs)
+  errbuf = mmap.mmap(-1, (nprocs-1) * _errbufsize)
   try:
     child_pids = []
     for procid in builtins.range(1, nprocs):
@@ -70,11 +110,11 @@ def fork(nprocs=None):
       child_pids.append(pid)
     else:
       procid = 0
-    with maxprocs(1):
+    with maxprocs(1), _numthreads(nthreads), _pinned(procid, nprocs):
       yield procid
   except BaseException as e:
     if amchild: # pragma: no cover
-      print('[parallel.fork] exception in child process:', e)
+      _dumpexc(memoryview(errbuf)[(procid-1)*_errbufsize:procid*_errbufsize], e)
       os._exit(1) # communicate failure to main process
     for pid in child_pids: # kill all child processes
       os.kill(pid, signal.SIGKILL)
@@ -83,15 +123,150 @@ def fork(nprocs=None):
     if amchild: # pragma: no cover
       os._exit(0) # communicate success to main process
     with treelog.context('waiting for child processes'):
-      nfails = sum(os.waitpid(pid, 0)[1] != 0 for pid in child_pids)
-    if nfails: # failure in child process: raise exception
-      raise Exception('fork failed in {} out of {} processes'.format(nfails, nprocs))
+      failed = [procid for procid, pid in enumerate(child_pids, start=1) if os.waitpid(pid, 0)[1] != 0]
+    if failed: # failure in child process: raise exception
+      e, tb = _loadexc(memoryview(errbuf)[(failed[0]-1)*_errbufsize:failed[0]*_errbufsize], failed[0])
+      if e is None: # exception cannot be transferred: raise generic exception
+        raise Exception('fork failed in {} out of {} processes'.format(len(failed), nprocs)) from tb
+      raise e from tb
   finally:
     if amchild: # pragma: no cover
       os._exit(1) # failsafe
 
+class _ChildTraceback(Exception):
+  '''formatted traceback of an exception raised in a child process'''
+
+  def __str__(self):
+    return self.args[0]
+
+def _dumpexc(buf, e):
+  '''serialise exception, traceback and current item to buffer'''
+
+  tb = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+  try:
+    data = pickle.dumps((e, tb, _item.value))
+  except Exception: # exception cannot be pickled
+    data = b''
+  if not data or len(data) > len(buf) - 4:
+    data = pickle.dumps((None, tb[-len(buf)//2:], _item.value))
+  buf[:4] = len(data).to_bytes(4, 'little')
+  buf[4:4+len(data)] = data
+
+def _loadexc(buf, procid):
+  '''deserialise exception and its traceback from buffer
+
+  Returns the exception, or None if it could not be transferred, and the
+  traceback as a :class:`_ChildTraceback`, or None if it is unavailable.'''
+
+  n = int.from_bytes(buf[:4], 'little')
+  if not n: # child process was terminated without raising an exception
+    return None, None
+  try:
+    e, tb, item = pickle.loads(buf[4:4+n])
+  except Exception: # exception cannot be unpickled
+    return None, None
+  if tb is not None:
+    tb = _ChildTraceback('traceback in process {}{}:\n{}'.format(procid, '' if item is None else ' while processing item {}'.format(item), tb.rstrip()))
+  return e, tb
+
+def _nthreads(nprocs):
+  '''number of native threads per process according to the thread policy'''
+
+  policy = _threadpolicy.value
+  if policy == 'single':
+    return 1
+  if policy == 'divide':
+    ncores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    return max(ncores // nprocs, 1)
+  return None
+
+def _threadpools():
+  '''getter, setter pairs for all loaded native thread pools
+
+  The discovery is cached, and repeated only if modules were imported since,
+  as these may have loaded additional libraries.'''
+
+  global _threadpoolcache
+  nmodules, threadpools = _threadpoolcache
+  if nmodules != len(sys.modules):
+    threadpools = tuple(_findthreadpools())
+    _threadpoolcache = len(sys.modules), threadpools
+  return threadpools
+
+def _findthreadpools():
+  '''generate getter, setter pairs for all loaded native thread pools'''
+
+  try:
+    with open('/proc/self/maps') as f:
+      paths = {line.split()[-1] for line in f if '/' in line}
+  except OSError: # not linux
+    return
+  for path in sorted(paths):
+    name = os.path.basename(path)
+    if 'openblas' in name:
+      symbols = [('openblas_get_num_threads'+suffix, 'openblas_set_num_threads'+suffix) for suffix in ('', '64_')]
+    elif 'mkl_rt' in name:
+      symbols = [('MKL_Get_Max_Threads', 'MKL_Set_Num_Threads')]
+    else:
+      continue
+    try:
+      lib = ctypes.CDLL(path)
+    except OSError:
+      continue
+    for getter, setter in symbols:
+      if hasattr(lib, getter) and hasattr(lib, setter):
+        yield getattr(lib, getter), getattr(lib, setter)
+
+@contextlib.contextmanager
+def _numthreads(nthreads):
+  '''temporarily limit the number of threads of all native thread pools'''
+
+  if nthreads is None:
+    yield
+    return
+  threadpools = [(getter(), setter) for getter, setter in _threadpools()]
+  for oldvalue, setter in threadpools:
+    setter(nthreads)
+  try:
+    yield
+  finally:
+    for oldvalue, setter in threadpools:
+      setter(oldvalue)
+
+@contextlib.contextmanager
+def _pinned(procid, nprocs):
+  '''temporarily bind the current process to its share of the available cores'''
+
+  if not _pinning.value or not hasattr(os, 'sched_setaffinity'):
+    yield
+    return
+  cpus = sorted(os.sched_getaffinity(0))
+  mycpus = cpus[procid*len(cpus)//nprocs:(procid+1)*len(cpus)//nprocs] or cpus[procid%len(cpus):][:1]
+  os.sched_setaffinity(0, mycpus)
+  try:
+    yield
+  finally:
+    os.sched_setaffinity(0, cpus)
+
 def shempty(shape, dtype=float):
-  '''create uninitialized array in shared memory'''
+  '''create uninitialized array in shared memory
+
+  Memory pages are not touched until they are first written to. In a parallel
+  section this means that the process that first writes a page determines its
+  physical location, which on NUMA architectures is local to that process.'''
+
+  return _shempty(shape, dtype)[0]
+
+def shzeros(shape, dtype=float):
+  '''create zero-initialized array in shared memory'''
+
+  array, zeroed = _shempty(shape, dtype)
+  if not zeroed:
+    array.fill(0)
+  return array
+
+def _shempty(shape, dtype):
+  '''helper function for shempty and shzeros'''
 
   if numeric.isint(shape):
     shape = shape,
@@ -102,19 +277,12 @@ def shempty(shape, dtype=float):
   for sh in shape:
     size *= int(sh)
   if size == 0 or _maxprocs.value == 1:
-    return numpy.empty(shape, dtype)
+    return numpy.empty(shape, dtype), False
   # `mmap(-1,...)` will allocate *anonymous* memory.  Although linux' man page
   # mmap(2) states that anonymous memory is initialized to zero, we can't rely
   # on this to be true for all platforms (see [SO-mmap]).  [SO-mmap]:
   # https://stackoverflow.com/a/17896084
-  return numpy.frombuffer(mmap.mmap(-1, size), dtype).reshape(shape)
-
-def shzeros(shape, dtype=float):
-  '''create zero-initialized array in shared memory'''
-
-  array = shempty(shape, dtype=dtype)
-  array.fill(0)
-  return array
+  return numpy.frombuffer(mmap.mmap(-1, size), dtype).reshape(shape), sys.platform.startswith('linux')
 
 class range:
   '''a shared range-like iterable that yields every index exactly once'''
@@ -135,11 +303,21 @@ class range:
 
 @contextlib.contextmanager
 def ctxrange(name, nitems):
-  '''fork and yield shared range-like counter with percentage-style logging'''
+  '''fork and yield shared range-like counter with percentage-style logging
+
+  Every process records the number of items it processed, the time spent
+  processing them and the moment it ran out of items in shared memory. Upon
+  completion of a parallel region the load balance of the processes is logged
+  at debug level.'''
 
   rng = range(nitems) # shared range, must be created pre-fork
-  with fork(nitems), treelog.iter.wrap(_pct(name, nitems), rng) as wrprng:
+  nprocs = max(min(nitems, _maxprocs.value), 1) if hasattr(os, 'fork') else 1
+  stats = shzeros([nprocs, 3]) # number of items, busy time, time of completion
+  t0 = time.perf_counter()
+  with fork(nitems) as procid, treelog.iter.wrap(_pct(name, nitems), _timed(rng, stats[procid])) as wrprng:
     yield wrprng
+  if nprocs > 1:
+    _report(name, stats, t0, time.perf_counter())
 
 def _pct(name, n):
   '''helper function for ctxrange'''
@@ -148,4 +326,23 @@ def _pct(name, n):
   while True:
     i = yield name + ' {:.0f}%'.format(100*(i+1)/n)
 
+def _timed(items, stats):
+  '''helper function for ctxrange'''
+
+  for item in items:
+    t0 = time.perf_counter()
+    with _item.sets(item):
+      yield item
+    stats[:2] += 1, time.perf_counter() - t0
+  stats[2] = time.perf_counter() # perf_counter is system wide, hence comparable between processes
+
+def _report(name, stats, t0, t1):
+  '''helper function for ctxrange'''
+
+  nitems, busy, done = stats.T
+  walltime = t1 - t0
+  idle = t1 - done # time spent waiting for the other processes to complete
+  treelog.debug('{} completed by {} processes in {:.2f}s; items min/max/mean {:.0f}/{:.0f}/{:.1f}; busy min/max/mean {:.2f}/{:.2f}/{:.2f}s; idle min/max/mean {:.2f}/{:.2f}/{:.2f}s; efficiency {:.0f}%'.format(
+    name, len(stats), walltime, nitems.min(), nitems.max(), nitems.mean(), busy.min(), busy.max(), busy.mean(), idle.min(), idle.max(), idle.mean(), 100 * busy.mean() / walltime if walltime else 100))
+
 # vim:sw=2:sts=2:et
@@ -257,10 +257,34 @@ class Sample(types.Singleton):
     if graphviz:
       idata.graphviz(graphviz)
 
+    # If the points of different elements are disjoint then every process can
+    # safely write into its own part of the shared return values. Otherwise
+    # every process accumulates into a private buffer, and the buffers are
+    # reduced after all elements are evaluated.
+
+    nprocs = min(parallel._maxprocs.value, self.nelems)
+    private = nprocs > 1 and not self._isdisjoint
+    if private:
+      buffers = [parallel.shzeros((nprocs,)+retval.shape, dtype=retval.dtype) for retval in retvals]
+      slots = parallel.range(nprocs)
+
     with parallel.ctxrange('evaluating', self.nelems) as ielems:
+      if private:
+        slot = next(slots) # one slot per process, shared by all functions
+        targets = [buffer[slot] for buffer in buffers]
+      else:
+        targets = retvals
       for ielem in ielems:
+        index = self.getindex(ielem)
         for ifunc, inds, data in idata.eval(_transforms=tuple(t[ielem] for t in self.transforms), _points=self.points[ielem].coords, **arguments):
-          numpy.add.at(retvals[ifunc], numpy.ix_(self.getindex(ielem), *[ind for (ind,) in inds]), data)
+          _accumulate(targets[ifunc], index, [ind for (ind,) in inds], data)
+
+    if private:
+      with parallel.ctxrange('reducing', (self.npoints-1) // _reducechunk + 1) as ichunks:
+        for ichunk in ichunks:
+          chunk = slice(ichunk*_reducechunk, (ichunk+1)*_reducechunk)
+          for retval, buffer in zip(retvals, buffers):
+            numpy.sum(buffer[:,chunk], axis=0, out=retval[chunk])
 
     return retvals
 
@@ -355,6 +379,8 @@ class _DefaultIndex(Sample):
   __slots__ = ()
   __cache__ = 'offsets'
 
+  _isdisjoint = True
+
   @property
   def offsets(self):
     return numpy.cumsum([0]+[p.npoints for p in self.points])
@@ -373,6 +399,7 @@ class _DefaultIndex(Sample):
 class _CustomIndex(Sample):
 
   __slots__ = '_index'
+  __cache__ = '_isdisjoint'
 
   def __init__(self, transforms, points, index):
     self._index = index
@@ -389,6 +416,31 @@ class _CustomIndex(Sample):
   def getindex(self, ielem):
     return self._index[ielem]
 
+  @property
+  def _isdisjoint(self):
+    index = numpy.concatenate(self._index)
+    return len(numpy.unique(index)) == len(index)
+
+_reducechunk = 1<<12 # number of points per chunk in the reduction of Sample.eval
+
+def _accumulate(target, index, inds, data):
+  '''add data to ``target[index,*inds]``
+
+  A range of consecutive point indices is added via a slice, and indices
+  without duplicates via buffered fancy indexing. Unbuffered
+  :func:`numpy.add.at` is used only when duplicates occur.'''
+
+  if len(index) and index[-1] - index[0] == len(index) - 1 and (numpy.diff(index) == 1).all():
+    where = (slice(index[0], index[-1]+1),) + numpy.ix_(*inds)
+  elif len(numpy.unique(index)) == len(index) and all(len(numpy.unique(ind)) == len(ind) for ind in inds):
+    where = numpy.ix_(index, *inds)
+  else:
+    numpy.add.at(target, numpy.ix_(index, *inds), data)
+    return
+  # Assign rather than add in place, to cast like numpy.add.at if the dtype
+  # of data exceeds that of target.
+  target[where] = target[where] + data
+
 class Integral(types.Singleton):
   '''Postponed integration.
 
@@ -548,8 +600,132 @@ class Integral(types.Singleton):
   def T(self):
     return Integral({sample: func.T for sample, func in self._integrands.items()}, shape=self.shape[::-1])
 
+  def operator(self, **arguments):
+    '''Matrix-free linear operator.
+
+    Return a :class:`IntegralOperator` that represents this two-dimensional
+    integral without assembling its entries.
+
+    Args
+    ----
+    arguments : :class:`dict`
+        Arguments for function evaluation.
+
+    Returns
+    -------
+    operator : :class:`IntegralOperator`
+    '''
+
+    if self.ndim != 2:
+      raise ValueError('operator requires a two-dimensional integral')
+    return IntegralOperator(self, argdict(arguments))
+
 strictintegral = types.strict[Integral]
 
+class IntegralOperator(matrix.Matrix):
+  '''Matrix-free linear operator.
+
+  Matrix that represents a two-dimensional :class:`Integral` without storing
+  its entries. Products with vectors evaluate the action of the integral
+  element by element, which makes the operator suitable for the iterative
+  solvers of scipy, such as 'cg' and 'gmres', or for the 'cg' and 'gmres'
+  solvers of the matrix base class if scipy is not installed, optionally with
+  the 'diag' preconditioner, the diagonal being integrated separately.
+  Exporting the operator assembles the full matrix in the active backend.
+  '''
+
+  def __init__(self, integral, arguments, rows=None, cols=None):
+    assert integral.ndim == 2
+    self._integral = integral
+    self._arguments = arguments
+    self._rows = numpy.ones(integral.shape[0], dtype=bool) if rows is None else rows
+    self._cols = numpy.ones(integral.shape[1], dtype=bool) if cols is None else cols
+    vector = function.Argument('_operator_vector', integral.shape[1:])
+    self._action = Integral({di: (func * vector).sum(-1) for di, func in integral._integrands.items()}, shape=integral.shape[:1])
+    super().__init__((int(self._rows.sum()), int(self._cols.sum())))
+
+  @property
+  def fingerprints(self):
+    if self._fingerprints is None:
+      pattern = types.nutils_hash((self._integral, types.frozenarray(self._rows), types.frozenarray(self._cols)))
+      self._fingerprints = pattern, types.nutils_hash(self._arguments)
+    return self._fingerprints
+
+  def _derive(self, integral, rows, cols):
+    if rows.shape != self._rows.shape or cols.shape != self._cols.shape:
+      raise matrix.MatrixError('non-matching shapes')
+    return IntegralOperator(integral, self._arguments, rows, cols)
+
+  def __add__(self, other):
+    if not isinstance(other, IntegralOperator):
+      raise TypeError('cannot add {} to IntegralOperator'.format(type(other).__name__))
+    if self.shape != other.shape or other._arguments != self._arguments or not numpy.equal(other._rows, self._rows).all() or not numpy.equal(other._cols, self._cols).all():
+      raise matrix.MatrixError('non-matching operators')
+    return self._derive(self._integral + other._integral, self._rows, self._cols)
+
+  def __mul__(self, other):
+    if not numeric.isnumber(other):
+      raise TypeError
+    return self._derive(self._integral * other, self._rows, self._cols)
+
+  def __neg__(self):
+    return self._derive(-self._integral, self._rows, self._cols)
+
+  @property
+  def T(self):
+    return IntegralOperator(self._integral.T, self._arguments, self._cols, self._rows)
+
+  def __matmul__(self, other):
+    if not isinstance(other, numpy.ndarray):
+      raise TypeError
+    if other.shape[0] != self.shape[1]:
+      raise matrix.MatrixError
+    if other.ndim != 1:
+      return numpy.stack([self @ column for column in other.reshape(len(other), -1).T], axis=1).reshape(self.shape[:1]+other.shape[1:])
+    vector = numpy.zeros(len(self._cols))
+    vector[self._cols] = other
+    retval, = eval_integrals(self._action, _operator_vector=vector, **self._arguments)
+    return retval[self._rows]
+
+  @property
+  def linearoperator(self):
+    '''The operator as a :class:`scipy.sparse.linalg.LinearOperator`.'''
+
+    import scipy.sparse.linalg
+    return scipy.sparse.linalg.LinearOperator(self.shape, matvec=self.__matmul__, dtype=float)
+
+  def _solver(self, rhs, solver, **kwargs):
+    try:
+      from .matrix import _scipy
+    except matrix.BackendNotAvailable:
+      pass # fall back on the solvers of the base class
+    else:
+      if solver in _scipy.methods:
+        kwargs['method'] = solver
+        solver = 'scipy'
+    return super()._solver(rhs, solver, **kwargs)
+
+  def _solver_scipy(self, rhs, **kwargs):
+    from .matrix import _scipy
+    return _scipy.ScipyMatrix._solver_scipy(self, rhs, **kwargs)
+
+  def diagonal(self):
+    if self.shape[0] != self.shape[1] or not numpy.equal(self._rows, self._cols).all():
+      raise matrix.MatrixError('failed to extract diagonal: operator is not square')
+    diagonal, = eval_integrals(Integral({di: function.takediag(func) for di, func in self._integral._integrands.items()}, shape=self._integral.shape[:1]), **self._arguments)
+    return diagonal[self._rows]
+
+  def _submatrix(self, rows, cols):
+    newrows = self._rows.copy()
+    newrows[newrows] = rows
+    newcols = self._cols.copy()
+    newcols[newcols] = cols
+    return self._derive(self._integral, newrows, newcols)
+
+  def export(self, form):
+    assembled, = eval_integrals(self._integral, **self._arguments)
+    return assembled.submatrix(self._rows, self._cols).export(form)
+
 @types.apply_annotations
 def eval_integrals(*integrals: types.tuple[strictintegral], **arguments:argdict):
   '''Evaluate integrals.
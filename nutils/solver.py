@@ -50,7 +50,7 @@ In addition to ``solve_linear`` the solver module defines ``newton`` and
 time dependent problems.
 """
 
-from . import function, cache, numeric, sample, types, util, matrix, warnings
+from . import function, cache, numeric, sample, sparse, types, util, matrix, warnings
 import abc, numpy, itertools, functools, numbers, collections, math, treelog as log
 
 
@@ -178,6 +178,15 @@ class newton(RecursionWithSolve, length=1):
       Callable that defines relaxation logic.
   failrelax : :class:`float`
       Fail with exception if relaxation reaches this lower limit.
+  jacreuse : :class:`int`
+      Maximum number of subsequent iterations that reuse the Jacobian, and
+      thereby its factorization, of an earlier iterate (modified Newton). Such
+      updates require only the residual and are accepted without line search
+      if the residual norm reduces by at least a factor ``reuserate``;
+      otherwise the Jacobian is refreshed. Defaults to 0 (full Newton).
+  reuserate : :class:`float`
+      Maximum ratio of subsequent residual norms for updates with a reused
+      Jacobian.
   arguments : :class:`collections.abc.Mapping`
       Defines the values for :class:`nutils.function.Argument` objects in
       `residual`.  The ``target`` should not be present in ``arguments``.
@@ -190,7 +199,7 @@ class newton(RecursionWithSolve, length=1):
   '''
 
   @types.apply_annotations
-  def __init__(self, target:types.strictstr, residual:sample.strictintegral, jacobian:sample.strictintegral=None, lhs0:types.frozenarray[types.strictfloat]=None, relax0:float=1., constrain:types.frozenarray=None, linesearch=None, failrelax:types.strictfloat=1e-6, arguments:argdict={}, **kwargs):
+  def __init__(self, target:types.strictstr, residual:sample.strictintegral, jacobian:sample.strictintegral=None, lhs0:types.frozenarray[types.strictfloat]=None, relax0:float=1., constrain:types.frozenarray=None, linesearch=None, failrelax:types.strictfloat=1e-6, jacreuse:types.strictint=0, reuserate:types.strictfloat=.5, arguments:argdict={}, **kwargs):
     super().__init__()
     if target in arguments:
       raise ValueError('`target` should not be defined in `arguments`')
@@ -201,6 +210,8 @@ class newton(RecursionWithSolve, length=1):
     self.relax0 = relax0
     self.linesearch = linesearch or NormBased.legacy(kwargs)
     self.failrelax = failrelax
+    self.jacreuse = jacreuse
+    self.reuserate = reuserate
     self.arguments = arguments
     self.solveargs = _strip(kwargs, 'lin')
     if kwargs:
@@ -211,24 +222,84 @@ class newton(RecursionWithSolve, length=1):
     res, jac = sample.eval_integrals(self.residual, self.jacobian, **{self.target: lhs}, **self.arguments)
     return res[self.free], jac.submatrix(self.free, self.free)
 
+  def _evalres(self, lhs):
+    res, = sample.eval_integrals(self.residual, **{self.target: lhs}, **self.arguments)
+    return res[self.free]
+
+  def _evaljac(self, lhs):
+    jac, = sample.eval_integrals(self.jacobian, **{self.target: lhs}, **self.arguments)
+    return jac.submatrix(self.free, self.free)
+
+  def _evaltrial(self, lhs, dlhs, res=None):
+    # evaluate residual and jacobian in sparse form, the latter assembled only
+    # if the update is accepted; the jacobian-vector product follows directly
+    # from the sparse data. If the residual is given, only the jacobian is
+    # evaluated
+    if res is None:
+      res, jac = sample.eval_integrals_sparse(self.residual, self.jacobian, **{self.target: lhs}, **self.arguments)
+      res = sparse.toarray(res)[self.free]
+    else:
+      jac, = sample.eval_integrals_sparse(self.jacobian, **{self.target: lhs}, **self.arguments)
+    direction = numpy.zeros(lhs.shape)
+    direction[self.free] = dlhs
+    (rows, cols), values, shape = sparse.extract(jac)
+    dres = numpy.bincount(rows, weights=values*direction[cols], minlength=len(lhs))
+    return res, dres[self.free], jac
+
+  def _assemble(self, jac):
+    return matrix.fromsparse(jac, inplace=True).submatrix(self.free, self.free)
+
   def resume(self, history):
     if history:
       lhs, info = history[-1]
-      res, jac = self._eval(lhs)
+      lhs = numpy.array(lhs) # cached iterates may be read-only
+      age = getattr(info, 'jacage', 0)
+      if age: # restore the jacobian of an earlier iterate
+        lhsjac = numpy.array(info.jaclhs)
+        res = self._evalres(lhs)
+        jac = self._evaljac(lhsjac)
+      else:
+        lhsjac = lhs.copy()
+        res, jac = self._eval(lhs)
       assert numpy.linalg.norm(res) == info.resnorm
       relax = info.relax
     else:
       lhs = self.lhs0.copy()
+      lhsjac = lhs.copy()
       res, jac = self._eval(lhs)
+      age = 0 # number of updates since the jacobian was evaluated
       relax = self.relax0
-      yield _ro(lhs), types.attributes(resnorm=numpy.linalg.norm(res), relax=relax)
+      yield _ro(lhs), self._info(res, relax, age, lhsjac)
     while True:
+      if age > self.jacreuse:
+        lhsjac = lhs.copy()
+        jac = self._evaljac(lhs)
+        age = 0
       dlhs = -jac.solve_leniently(res, **self.solveargs) # compute new search vector
       res0 = res
+      restrial = None
+      if self.jacreuse and relax == 1: # attempt a full update while retaining the jacobian
+        free0 = lhs[self.free]
+        lhs[self.free] += dlhs
+        res = self._evalres(lhs)
+        if numpy.linalg.norm(res) <= self.reuserate * numpy.linalg.norm(res0):
+          log.info('update accepted with {} jacobian'.format('reused' if age else 'new'))
+          age += 1
+          yield _ro(lhs), self._info(res, relax, age, lhsjac)
+          continue
+        lhs[self.free] = free0
+        if age: # retry with a new jacobian
+          res = res0
+          lhsjac = lhs.copy()
+          jac = self._evaljac(lhs)
+          age = 0
+          continue
+        restrial = res # the jacobian is new, so the full update is the first trial of the line search
+        res = res0
       dres = jac@dlhs # == -res if dlhs was solved to infinite precision
       lhs[self.free] += relax * dlhs
-      res, jac = self._eval(lhs)
-      scale, accept = self.linesearch(res0, relax*dres, res, relax*(jac@dlhs))
+      res, dres1, jacdata = self._evaltrial(lhs, dlhs, restrial)
+      scale, accept = self.linesearch(res0, relax*dres, res, relax*dres1)
       while not accept: # line search
         assert scale < 1
         oldrelax = relax
@@ -236,11 +307,19 @@ class newton(RecursionWithSolve, length=1):
         if relax <= self.failrelax:
           raise SolverError('stuck in local minimum')
         lhs[self.free] += (relax - oldrelax) * dlhs
-        res, jac = self._eval(lhs)
-        scale, accept = self.linesearch(res0, relax*dres, res, relax*(jac@dlhs))
+        res, dres1, jacdata = self._evaltrial(lhs, dlhs)
+        scale, accept = self.linesearch(res0, relax*dres, res, relax*dres1)
       log.info('update accepted at relaxation', round(relax, 5))
+      lhsjac = lhs.copy()
+      jac = self._assemble(jacdata)
+      age = 0
       relax = min(relax * scale, 1)
-      yield _ro(lhs), types.attributes(resnorm=numpy.linalg.norm(res), relax=relax)
+      yield _ro(lhs), self._info(res, relax, age, lhsjac)
+
+  def _info(self, res, relax, age, lhsjac):
+    if not self.jacreuse:
+      return types.attributes(resnorm=numpy.linalg.norm(res), relax=relax)
+    return types.attributes(resnorm=numpy.linalg.norm(res), relax=relax, jacage=age, jaclhs=_ro(lhsjac))
 
 
 class LineSearch(types.Immutable):
@@ -457,6 +536,7 @@ class minimize(RecursionWithSolve, length=1, version=3):
   def resume(self, history):
     if history:
       lhs, info = history[-1]
+      lhs = numpy.array(lhs) # cached iterates may be read-only
       nrg, res, jac = self._eval(lhs)
       assert nrg == info.energy
       assert numpy.linalg.norm(res) == info.resnorm
@@ -567,6 +647,7 @@ class pseudotime(RecursionWithSolve, length=1):
   def resume(self, history):
     if history:
       lhs, info = history[-1]
+      lhs = numpy.array(lhs) # cached iterates may be read-only
       resnorm0 = info.resnorm0
       timestep = info.timestep
       res, jac = self._eval(lhs, timestep)
@@ -612,6 +693,9 @@ class thetamethod(RecursionWithSolve, length=1, version=1):
       `constrain` (float).
   newtontol : :class:`float`
       Residual tolerance of individual timesteps
+  newtonargs : :class:`dict`
+      Additional arguments for :class:`newton`, for instance ``jacreuse`` to
+      retain the Jacobian for several iterations within a timestep.
   arguments : :class:`collections.abc.Mapping`
       Defines the values for :class:`nutils.function.Argument` objects in
       `residual`.  The ``target`` should not be present in ``arguments``.
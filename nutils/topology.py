@@ -337,6 +337,48 @@ class Topology(types.Singleton):
 
     return constrain
 
+  @log.withcontext
+  def prolongation(self, coarse, fine, degree, droptol=1e-12):
+    '''Prolongation matrix of nested function spaces.
+
+    Return the sparse matrix ``P`` that expresses the coarse basis functions in
+    terms of the fine basis functions, ``coarse[j] = sum_i P[i,j] fine[i]``,
+    as required by the 'multigrid' preconditioner (see
+    :func:`nutils.matrix.multigrid`). The topology is typically the one on
+    which ``fine`` is defined, such as ``coarsetopo.refined`` or a level of a
+    :class:`HierarchicalTopology`. The coarse space must be contained in the
+    fine space, and the fine basis functions must be linearly independent on
+    every element. The coefficients follow from element-local least squares
+    fits in the points of a Gauss scheme of the given degree, which should be
+    at least twice the polynomial degree of the bases.
+    '''
+
+    coarse = function.asarray(coarse)
+    fine = function.asarray(fine)
+    if coarse.ndim != 1 or fine.ndim != 1:
+      raise ValueError('prolongation requires scalar bases')
+    sample = self.sample('gauss', degree)
+    data = function.Tuple(function.Tuple(function.Tuple([function.Tuple(ind), f.simplified.optimized_for_numpy]) for ind, f in function.blocks(func.prepare_eval(ndims=self.ndims))) for func in (fine, coarse))
+    rows, cols, values = [], [], []
+    for ielem in log.iter.percentage('element', range(sample.nelems)):
+      points = sample.points[ielem]
+      (findex, fvalues), (cindex, cvalues) = [(numpy.concatenate([ind.reshape(-1) for (ind,), f in blocks]), numpy.concatenate([f for (ind,), f in blocks], axis=1)) for blocks in data.eval(_transforms=tuple(t[ielem] for t in sample.transforms), _points=points.coords)]
+      sqrtweights = numpy.sqrt(points.weights)[:,numpy.newaxis]
+      coeffs, residuals, rank, singular = numpy.linalg.lstsq(fvalues * sqrtweights, cvalues * sqrtweights, rcond=None)
+      if rank < len(findex):
+        raise ValueError('fine basis is not locally linearly independent')
+      if not numpy.allclose(fvalues @ coeffs, cvalues, rtol=0, atol=1e-10*max(abs(cvalues).max(), 1)):
+        raise ValueError('coarse basis is not contained in fine basis')
+      rows.append(numpy.repeat(findex, len(cindex)))
+      cols.append(numpy.tile(cindex, len(findex)))
+      values.append(coeffs.ravel())
+    # Coefficients of dofs that are shared by multiple elements are identical
+    # up to rounding errors; we average them.
+    keys, inverse = numpy.unique(numpy.concatenate(rows) * coarse.shape[0] + numpy.concatenate(cols), return_inverse=True)
+    values = numpy.bincount(inverse, numpy.concatenate(values)) / numpy.bincount(inverse)
+    keep = abs(values) > droptol
+    return matrix.assemble(values[keep], numpy.divmod(keys[keep], coarse.shape[0]), shape=(fine.shape[0], coarse.shape[0]))
+
   def refined_by(self, refine):
     'create refined space by refining dofs in existing one'
 
@@ -131,10 +131,17 @@ def _build_apply_annotations(signature):
       else:
         raise ValueError('Cannot create function definition with parameter {}.'.format(param))
       if param.annotation is param.empty:
-        pass
-      elif param.default is None:
-        # Omit the annotation if the argument is the default is None.
-        body.append('  {arg} = None if {arg} is None else {ann}({arg})\n'.format(arg=name, ann=add_local(param.annotation)))
+        continue
+      # Skip the annotation if the argument is already of its canonical type
+      # (see `_canonical_type`) or, if the default is None, if it is None.
+      skip = []
+      if param.default is None:
+        skip.append('{arg} is None')
+      canonical_type = _canonical_type(param.annotation)
+      if canonical_type is not None:
+        skip.append('{arg}.__class__ is {cls}'.format(arg='{arg}', cls=add_local(canonical_type)))
+      if skip:
+        body.append('  if not ({skip}): {arg} = {ann}({arg})\n'.format(skip=' or '.join(skip).format(arg=name), arg=name, ann=add_local(param.annotation)))
       else:
         body.append('  {arg} = {ann}({arg})\n'.format(arg=name, ann=add_local(param.annotation)))
     f = 'def apply({params}):\n{body}  return ({args}), {{{kwargs}}}\n'.format(params=','.join(params), body=''.join(body), args=''.join(arg+',' for arg in args), kwargs=','.join(kwargs))
@@ -157,6 +164,18 @@ def _build_apply_annotations(signature):
   apply.returns_canonical_arguments = True
   return apply
 
+def _canonical_type(annotation):
+  '''Return the type of which instances are returned unchanged by
+  ``annotation``, or ``None``.  Annotations can declare this type via the
+  attribute ``canonical_type``.'''
+
+  try:
+    return _canonical_types[annotation]
+  except (KeyError, TypeError):
+    return getattr(annotation, 'canonical_type', None)
+
+_canonical_types = {t: t for t in (bool, int, float, complex, str, bytes, builtins.tuple, frozenset)}
+
 def apply_annotations(wrapped):
   '''
   Decorator that applies annotations to arguments.  All annotations should be
@@ -274,20 +293,23 @@ def nutils_hash(data):
       The hash of ``data``.
   '''
 
-  try:
-    return data.__nutils_hash__
-  except AttributeError:
-    pass
-
   t = type(data)
-  h = hashlib.sha1(t.__name__.encode()+b'\0')
+  h = _hashprefixes.get(t)
+  if h is not None: # builtin type, skip the attribute lookup
+    h = h.copy()
+  else:
+    try:
+      return data.__nutils_hash__
+    except AttributeError:
+      pass
+    h = hashlib.sha1(t.__name__.encode()+b'\0')
   if data is Ellipsis:
     pass
   elif data is None:
     pass
-  elif any(data is dtype for dtype in (bool, int, float, complex, str, bytes, builtins.tuple, frozenset, type(Ellipsis), type(None))):
+  elif t is type and data in _hashtypes:
     h.update(hashlib.sha1(data.__name__.encode()).digest())
-  elif any(t is dtype for dtype in (bool, int, float, complex)):
+  elif t is int or t is float or t is bool or t is complex:
     h.update(hashlib.sha1(repr(data).encode()).digest())
   elif t is str:
     h.update(hashlib.sha1(data.encode()).digest())
@@ -312,6 +334,9 @@ def nutils_hash(data):
     raise TypeError('unhashable type: {!r} {!r}'.format(data, t))
   return h.digest()
 
+_hashtypes = frozenset([bool, int, float, complex, str, bytes, builtins.tuple, frozenset, type(Ellipsis), type(None)])
+_hashprefixes = {t: hashlib.sha1(t.__name__.encode()+b'\0') for t in _hashtypes}
+
 class _CacheMeta_property:
   '''
   Memoizing property used by :class:`CacheMeta`.
@@ -710,6 +735,50 @@ class Singleton(Immutable, metaclass=SingletonMeta):
   __hash__ = Immutable.__hash__
   __eq__ = object.__eq__
 
+def singletons():
+  '''
+  Return the number of registered, live instances and their approximate
+  memory usage in bytes per :class:`Singleton` subclass, as a :class:`dict`
+  mapping the qualified class name to a tuple of count and size.  The size
+  comprises the instances and their direct arguments, including the data of
+  arrays; arguments shared by several instances of the same class are counted
+  once.
+
+  Examples
+  --------
+
+  >>> class Pair(Singleton):
+  ...   def __init__(self, a, b):
+  ...     pass
+  >>> pairs = [Pair(i, 'spam') for i in range(3)]
+  >>> count, size = singletons()[Pair.__module__+'.'+Pair.__qualname__]
+  >>> count
+  3
+  '''
+
+  stats = {}
+  classes = [Singleton]
+  while classes:
+    cls = classes.pop()
+    classes.extend(cls.__subclasses__())
+    instances = list(cls._cache.values())
+    if not instances:
+      continue
+    seen = set()
+    size = 0
+    for instance in instances:
+      size += sys.getsizeof(instance)
+      for arg in itertools.chain(instance._args, instance._kwargs.values()):
+        if id(arg) not in seen:
+          seen.add(id(arg))
+          size += sys.getsizeof(arg)
+          if isinstance(arg, frozenarray):
+            size += numpy.asarray(arg).nbytes
+    name = '{}.{}'.format(cls.__module__, cls.__qualname__)
+    count, oldsize = stats.get(name, (0, 0))
+    stats[name] = count + len(instances), oldsize + size
+  return stats
+
 def strictint(value):
   '''
   Converts any type that is a subclass of :class:`numbers.Integral` (e.g.
@@ -736,10 +805,14 @@ def strictint(value):
   ValueError: not an integer: '1'
   '''
 
+  if value.__class__ is builtins.int:
+    return value
   if not isinstance(value, numbers.Integral):
     raise ValueError('not an integer: {!r}'.format(value))
   return builtins.int(value)
 
+strictint.canonical_type = builtins.int
+
 def strictfloat(value):
   '''
   Converts any type that is a subclass of :class:`numbers.Real` (e.g.
@@ -765,10 +838,14 @@ def strictfloat(value):
   ValueError: not a real number: '1.2'
   '''
 
+  if value.__class__ is builtins.float:
+    return value
   if not isinstance(value, numbers.Real):
     raise ValueError('not a real number: {!r}'.format(value))
   return builtins.float(value)
 
+strictfloat.canonical_type = builtins.float
+
 def strictstr(value):
   '''
   Returns ``value`` unmodified if it is a :class:`str`, and fails otherwise.
@@ -797,6 +874,8 @@ def strictstr(value):
     raise ValueError("not a 'str': {!r}".format(value))
   return value
 
+strictstr.canonical_type = str
+
 def _getname(value):
   name = []
   if hasattr(value, '__module__'):
@@ -827,6 +906,7 @@ class _strictmeta(type):
         raise ValueError('expected an object of type {!r} but got {!r} with type {!r}'.format(cls.__qualname__, value, type(value).__qualname__))
       return value
     constructor.__qualname__ = constructor.__name__ = 'strict[{}]'.format(_getname(cls))
+    constructor.canonical_type = cls
     return constructor
   def __call__(*args, **kwargs):
     raise TypeError("cannot create an instance of class 'strict'")
@@ -855,8 +935,11 @@ class strict(metaclass=_strictmeta):
 
 class _tuplemeta(type):
   def __getitem__(self, itemtype):
+    itemcls = _canonical_type(itemtype)
     @_copyname(src=self, suffix='[{}]'.format(_getname(itemtype)))
     def constructor(value):
+      if itemcls is not None and value.__class__ is builtins.tuple and all(item.__class__ is itemcls for item in value):
+        return value
       return builtins.tuple(map(itemtype, value))
     return constructor
   @staticmethod
@@ -889,6 +972,8 @@ class tuple(builtins.tuple, metaclass=_tuplemeta):
 
   __slots__ = ()
 
+_canonical_types[tuple] = builtins.tuple
+
 class _frozendictmeta(CacheMeta):
   def __getitem__(self, keyvaluetype):
     if not isinstance(keyvaluetype, builtins.tuple) or len(keyvaluetype) != 2:
@@ -1107,6 +1192,8 @@ class _frozenarraymeta(CacheMeta):
       return self(value, dtype=dtype)
     return constructor
 
+_hashchunksize = 1<<24
+
 class frozenarray(collections.abc.Sequence, metaclass=_frozenarraymeta):
   '''
   An immutable version (and drop-in replacement) of :class:`numpy.ndarray`.
@@ -1180,7 +1267,15 @@ class frozenarray(collections.abc.Sequence, metaclass=_frozenarraymeta):
   @property
   def __nutils_hash__(self):
     h = hashlib.sha1('{}.{}\0{} {}'.format(type(self).__module__, type(self).__qualname__, self.__base.shape, self.__base.dtype.str).encode())
-    h.update(self.__base.tobytes())
+    base = self.__base
+    if base.dtype.hasobject:
+      h.update(base.tobytes())
+    elif base.flags.c_contiguous:
+      h.update(base)
+    else: # hash in chunks of rows to avoid a full copy
+      step = max(1, _hashchunksize // max(1, base[:1].nbytes))
+      for i in range(0, len(base), step):
+        h.update(base[i:i+step].tobytes())
     return h.digest()
 
   @property
@@ -1287,6 +1382,8 @@ class frozenarray(collections.abc.Sequence, metaclass=_frozenarraymeta):
   cumsum = lambda self, *args, **kwargs: frozenarray(self.__base.cumsum(*args, **kwargs), copy=False)
   nonzero = lambda self, *args, **kwargs: frozenarray(self.__base.nonzero(*args, **kwargs), copy=False)
 
+_canonical_types[frozenarray] = frozenarray
+
 class _c_arraymeta(type):
   def __getitem__(self, dtype):
     def constructor(value):
@@ -1,11 +1,11 @@
 from nutils import *
 from nutils.testing import *
-import sys, contextlib, tempfile, pathlib, threading
+import numpy, sys, os, time, contextlib, tempfile, pathlib, threading, itertools
 
 @contextlib.contextmanager
-def tmpcache():
+def tmpcache(**kwargs):
   with tempfile.TemporaryDirectory() as tmpdir:
-    with cache.enable(tmpdir):
+    with cache.enable(tmpdir, **kwargs):
       yield pathlib.Path(tmpdir)
 
 class TestException(Exception): pass
@@ -35,6 +35,47 @@ class function(TestCase):
       self.assertEqual(func(), 'spam')
       self.assertEqual(ncalls, 1)
 
+  def test_cache_memory(self):
+
+    @cache.function
+    def func(a):
+      nonlocal ncalls
+      ncalls += 1
+      return 'spam' * a
+
+    with tmpcache(memsize=1<<10) as cachedir:
+      ncalls = 0
+      self.assertEqual(func(1), 'spam')
+      self.assertEqual(ncalls, 1)
+      for cache_file in cachedir.iterdir():
+        cache_file.unlink()
+      self.assertEqual(func(1), 'spam')
+      self.assertEqual(ncalls, 1)
+      self.assertEqual(func(1000), 'spam' * 1000) # exceeds memsize
+      self.assertEqual(ncalls, 2)
+      for cache_file in cachedir.iterdir():
+        cache_file.unlink()
+      self.assertEqual(func(1000), 'spam' * 1000)
+      self.assertEqual(ncalls, 3)
+
+  def test_cache_memory_modify(self):
+
+    @cache.function
+    def func(a):
+      nonlocal ncalls
+      ncalls += 1
+      return numpy.arange(a)
+
+    with tmpcache(memsize=1<<10):
+      ncalls = 0
+      value = func(3)
+      value[0] = 10 # modify value returned on miss
+      self.assertEqual(func(3).tolist(), [0, 1, 2])
+      value = func(3)
+      value[0] = 10 # modify value returned from memory
+      self.assertEqual(func(3).tolist(), [0, 1, 2])
+      self.assertEqual(ncalls, 1)
+
   def test_cache_with_args(self):
 
     @cache.function
@@ -235,6 +276,444 @@ class function(TestCase):
       self.assertEqual(nsuccess, 2)
 
 
+class arrays(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    npythreshold = cache._npythreshold
+    cache._npythreshold = 80
+    self.addCleanup(setattr, cache, '_npythreshold', npythreshold)
+
+  def test_mmap(self):
+
+    @cache.function
+    def func(n):
+      nonlocal ncalls
+      ncalls += 1
+      return numpy.arange(n, dtype=float), 'spam'
+
+    with tmpcache() as cachedir:
+      ncalls = 0
+      array, spam = func(100)
+      self.assertEqual(ncalls, 1)
+      self.assertIs(type(array), numpy.ndarray)
+      self.assertEqual(len(tuple(cachedir.glob('*.npy'))), 1)
+      array, spam = func(100)
+      self.assertEqual(ncalls, 1)
+      self.assertIs(type(array), numpy.ndarray)
+      self.assertEqual(spam, 'spam')
+      self.assertAllEqual(array, numpy.arange(100))
+      array[:] = 0 # modify value returned on hit
+      array, spam = func(100)
+      self.assertEqual(ncalls, 1)
+      self.assertAllEqual(array, numpy.arange(100))
+
+  def test_rewrite(self):
+
+    @cache.function
+    def func(n):
+      nonlocal ncalls
+      ncalls += 1
+      return numpy.arange(n, dtype=float), 'spam'
+
+    with tmpcache() as cachedir:
+      ncalls = 0
+      func(100)
+      mapped, spam = func(100)
+      npy_file, = cachedir.glob('*.npy')
+      inode = npy_file.stat().st_ino
+      cache_file, = cachedir.glob('*[!y]')
+      cache_file.unlink()
+      func(100) # rewrites the npy file
+      self.assertEqual(ncalls, 2)
+      self.assertNotEqual(npy_file.stat().st_ino, inode) # replaced rather than truncated
+      self.assertEqual(len(tuple(cachedir.iterdir())), 2)
+      self.assertAllEqual(mapped, numpy.arange(100))
+
+  def test_mmap_frozenarray(self):
+
+    @cache.function
+    def func(n):
+      return types.frozenarray(numpy.arange(n, dtype=float))
+
+    with tmpcache() as cachedir:
+      for i in range(2):
+        array = func(100)
+        self.assertIsInstance(array, types.frozenarray)
+        self.assertAllEqual(array, numpy.arange(100))
+      self.assertEqual(len(tuple(cachedir.glob('*.npy'))), 1)
+
+  def test_memory(self):
+
+    @cache.function
+    def func(n):
+      nonlocal ncalls
+      ncalls += 1
+      return numpy.arange(n, dtype=float), types.frozenarray(numpy.arange(n, dtype=float))
+
+    with tmpcache() as cachedir:
+      ncalls = 0
+      func(100)
+      with cache.enable(cachedir, memsize=1<<20):
+        array, frozen = func(100) # load from disk
+        for i in range(2):
+          array, frozen_ = func(100) # load from memory
+          self.assertIs(frozen_, frozen)
+          self.assertIs(type(array), numpy.ndarray)
+          self.assertIsInstance(array.base, numpy.memmap)
+          self.assertAllEqual(array, numpy.arange(100))
+          array[:] = 0
+      self.assertEqual(ncalls, 1)
+
+  def test_small(self):
+
+    @cache.function
+    def func(n):
+      nonlocal ncalls
+      ncalls += 1
+      return numpy.arange(n, dtype=float), 'spam'
+
+    with tmpcache() as cachedir:
+      ncalls = 0
+      array, spam = func(5)
+      self.assertEqual(len(tuple(cachedir.glob('*.npy'))), 0)
+      array, spam = func(5)
+      self.assertEqual(ncalls, 1)
+      self.assertIsInstance(array, numpy.ndarray)
+
+  def test_missing(self):
+
+    @cache.function
+    def func(n):
+      nonlocal ncalls
+      ncalls += 1
+      return numpy.arange(n, dtype=float), 'spam'
+
+    with tmpcache() as cachedir:
+      ncalls = 0
+      func(100)
+      npyfile, = cachedir.glob('*.npy')
+      npyfile.unlink()
+      array, spam = func(100)
+      self.assertEqual(ncalls, 2)
+      self.assertAllEqual(array, numpy.arange(100))
+      self.assertTrue(npyfile.exists())
+
+  def test_gc(self):
+
+    @cache.function
+    def func(n):
+      return numpy.arange(n, dtype=float), 'spam'
+
+    with tmpcache() as cachedir:
+      func(100)
+      func(101)
+      self.assertEqual(len(tuple(cachedir.iterdir())), 4)
+      cache.gc(cachedir, maxsize=2000)
+      self.assertEqual(len(tuple(cachedir.iterdir())), 2)
+
+@parametrize
+class codec(TestCase):
+
+  def test_compressed(self):
+
+    @cache.function
+    def func(n):
+      nonlocal ncalls
+      ncalls += 1
+      return numpy.linspace(0, 1, n), 'spam' * n
+
+    with tmpcache(codec=self.codec) as cachedir:
+      ncalls = 0
+      array, spam = func(10000)
+      cache_file, = cachedir.iterdir()
+      self.assertLess(cache_file.stat().st_size, 50000)
+      with cache_file.open('rb') as f:
+        header, data = cache._load(f, cache_file)
+      self.assertEqual(header['codec'], self.codec)
+      array, spam = func(10000)
+      self.assertEqual(ncalls, 1)
+      self.assertIs(type(array), numpy.ndarray)
+      self.assertAllEqual(array, numpy.linspace(0, 1, 10000))
+      self.assertEqual(spam, 'spam' * 10000)
+
+  def test_small(self):
+
+    @cache.function
+    def func(n):
+      nonlocal ncalls
+      ncalls += 1
+      return numpy.linspace(0, 1, n), 'spam' * n
+
+    with tmpcache(codec=self.codec) as cachedir:
+      ncalls = 0
+      func(10)
+      cache_file, = cachedir.iterdir()
+      with cache_file.open('rb') as f:
+        header, data = cache._load(f, cache_file)
+      self.assertNotIn('codec', header)
+      array, spam = func(10)
+      self.assertEqual(ncalls, 1)
+      self.assertIsInstance(array, numpy.ndarray)
+
+  def test_corruption(self):
+
+    @cache.function
+    def func(n):
+      nonlocal ncalls
+      ncalls += 1
+      return numpy.linspace(0, 1, n), 'spam' * n
+
+    with tmpcache(codec=self.codec) as cachedir:
+      ncalls = 0
+      func(10000)
+      cache_file, = cachedir.iterdir()
+      with cache_file.open('r+b') as f:
+        f.seek(-100, 2)
+        f.write(b'bogus'*20)
+      array, spam = func(10000)
+      self.assertEqual(ncalls, 2)
+      self.assertAllEqual(array, numpy.linspace(0, 1, 10000))
+
+for name in 'zlib', 'lzma', 'bz2':
+  codec(codec=name)
+
+class writebehind(TestCase):
+
+  def test_function(self):
+
+    @cache.function
+    def func(n):
+      nonlocal ncalls
+      ncalls += 1
+      return numpy.arange(n)
+
+    with tmpcache() as cachedir:
+      ncalls = 0
+      with cache.enable(cachedir, writebehind=2):
+        for n in range(5):
+          self.assertAllEqual(func(n), numpy.arange(n))
+      self.assertEqual(len(tuple(cachedir.iterdir())), 5)
+      for n in range(5):
+        self.assertAllEqual(func(n), numpy.arange(n))
+      self.assertEqual(ncalls, 5)
+
+  def test_modified_in_place(self):
+
+    @cache.function
+    def func(n):
+      nonlocal ncalls
+      ncalls += 1
+      return numpy.arange(n)
+
+    with tmpcache() as cachedir:
+      ncalls = 0
+      with cache.enable(cachedir, writebehind=2):
+        func(3)[:] = 0
+      self.assertAllEqual(func(3), numpy.arange(3))
+      self.assertEqual(ncalls, 1)
+
+  @unittest.skipIf(cache._lock_file is not cache._lock_file_fcntl, 'platform does not support flock')
+  def test_lock(self):
+
+    @cache.function
+    def func(n):
+      nonlocal ncalls
+      ncalls += 1
+      return numpy.arange(n)
+
+    import fcntl
+    release = threading.Event()
+    with tmpcache(writebehind=2) as cachedir:
+      ncalls = 0
+      cache._writer.value.submit(release.wait, lambda result: None)
+      func(3)
+      cache_file, = cachedir.iterdir()
+      with cache_file.open('rb') as f:
+        with self.assertRaises(BlockingIOError):
+          fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        release.set()
+        fcntl.flock(f, fcntl.LOCK_EX)
+        self.assertGreater(cache_file.stat().st_size, 0)
+      self.assertEqual(ncalls, 1)
+
+  def test_recursion(self):
+
+    class R(cache.Recursion, length=1):
+      def resume(R_self, history):
+        nonlocal ncalls
+        ncalls += 1
+        yield from range(0 if not history else history[-1]+1, 10)
+
+    with tmpcache() as cachedir:
+      ncalls = 0
+      with cache.enable(cachedir, writebehind=2):
+        self.assertEqual(tuple(itertools.islice(R(), 4)), tuple(range(4)))
+        self.assertEqual(tuple(R()), tuple(range(10)))
+      self.assertEqual(ncalls, 2)
+      self.assertEqual(tuple(R()), tuple(range(10)))
+      self.assertEqual(ncalls, 2)
+
+class statistics(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.cachedir = pathlib.Path(self.enter_context(tempfile.TemporaryDirectory()))
+
+  def test_function(self):
+
+    @cache.function
+    def func(n):
+      time.sleep(.01)
+      return 'spam' * n
+
+    with cache.statistics() as stats, cache.enable(self.cachedir, memsize=1<<10):
+      func(1)
+      func(1) # from memory
+      func(2)
+    with cache.statistics() as stats2, cache.enable(self.cachedir):
+      func(1) # from disk
+    item, = stats.values()
+    self.assertEqual((item.hits, item.misses, item.bytesread), (1, 2, 0))
+    self.assertGreater(item.byteswritten, 0)
+    self.assertGreaterEqual(item.saved, .01)
+    item, = stats2.values()
+    self.assertEqual((item.hits, item.misses, item.byteswritten), (1, 0, 0))
+    self.assertGreater(item.bytesread, 0)
+    self.assertGreaterEqual(item.saved, .01)
+
+  def test_recursion(self):
+
+    class R(cache.Recursion, length=1):
+      def resume(R_self, history):
+        yield from range(0 if not history else history[-1]+1, 10)
+
+    with cache.statistics() as stats, cache.enable(self.cachedir):
+      tuple(itertools.islice(R(), 4))
+      tuple(R())
+    item = stats[R.__module__ + '.' + R.__qualname__]
+    self.assertEqual((item.hits, item.misses), (4, 11))
+    self.assertGreater(item.bytesread, 0)
+    self.assertGreater(item.byteswritten, 0)
+
+  def test_report(self):
+
+    @cache.function
+    def func():
+      return 'spam'
+
+    recordlog = treelog.RecordLog()
+    with treelog.set(recordlog), cache.statistics(), cache.enable(self.cachedir):
+      func()
+    messages = [args[0] for cmd, *args in recordlog._messages if cmd == 'write' and args[1] == treelog.proto.Level.info]
+    self.assertEqual(len(messages), 1)
+    self.assertRegex(messages[0], r'test_report\.<locals>\.func: 0 hits, 1 misses, 0 bytes read, [0-9,]+ bytes written')
+
+class MemoryCache(TestCase):
+
+  def test_evict(self):
+    memcache = cache.MemoryCache(10)
+    memcache['a'] = 'A', 4
+    memcache['b'] = 'B', 4
+    self.assertEqual(memcache['a'], 'A')
+    memcache['c'] = 'C', 4
+    self.assertEqual(len(memcache), 2)
+    self.assertEqual(memcache.size, 8)
+    self.assertNotIn('b', memcache)
+    self.assertEqual(memcache['a'], 'A')
+    self.assertEqual(memcache['c'], 'C')
+
+  def test_oversized(self):
+    memcache = cache.MemoryCache(10)
+    memcache['a'] = 'A', 4
+    memcache['a'] = 'A', 11
+    self.assertEqual(len(memcache), 0)
+    self.assertEqual(memcache.size, 0)
+
+class gc(TestCase):
+
+  def populate(self, cachedir, func, *args):
+    paths = []
+    for i, arg in enumerate(args):
+      func(*arg)
+      path, = set(cachedir.iterdir()).difference(paths)
+      os.utime(str(path), (i, i)) # make sure the order of modification times is well defined
+      paths.append(path)
+    return paths
+
+  def test_report(self):
+
+    @cache.function
+    def func(n):
+      return 'x' * n
+
+    with tmpcache() as cachedir:
+      self.populate(cachedir, func, (100,), (200,))
+      self.assertEqual(cache.gc(cachedir), sum(path.stat().st_size for path in cachedir.iterdir()))
+      self.assertEqual(len(tuple(cachedir.iterdir())), 2)
+
+  def test_lru(self):
+
+    @cache.function
+    def func(n):
+      return 'x' * n
+
+    with tmpcache() as cachedir:
+      paths = self.populate(cachedir, func, (1000,), (1001,), (1002,))
+      size = paths[1].stat().st_size + paths[2].stat().st_size
+      usage = cache.gc(cachedir, maxsize=size+100)
+      self.assertEqual(sorted(cachedir.iterdir()), sorted(paths[1:]))
+      self.assertEqual(usage, size)
+
+  def test_cost(self):
+
+    @cache.function
+    def func(n, sleep):
+      time.sleep(sleep)
+      return 'x' * n
+
+    with tmpcache() as cachedir:
+      paths = self.populate(cachedir, func, (1000, 0), (1001, .1), (1002, 0))
+      cache.gc(cachedir, maxsize=paths[1].stat().st_size, policy='cost')
+      self.assertEqual(list(cachedir.iterdir()), [paths[1]])
+
+  def test_invalid_policy(self):
+    with self.assertRaises(ValueError), tmpcache() as cachedir:
+      cache.gc(cachedir, policy='bogus')
+
+  def test_limit_on_write(self):
+
+    @cache.function
+    def func(n):
+      return 'x' * n
+
+    with tmpcache(maxsize=3000) as cachedir:
+      for n in range(1000, 1010):
+        func(n)
+        self.assertLessEqual(sum(path.stat().st_size for path in cachedir.iterdir()), 3000)
+      self.assertGreater(len(tuple(cachedir.iterdir())), 0)
+
+  def test_main(self):
+
+    @cache.function
+    def func(n):
+      return 'x' * n
+
+    with tmpcache() as cachedir:
+      self.populate(cachedir, func, (1000,), (1001,))
+      self.assertEqual(cache._main(['gc', str(cachedir), '1k']), 0)
+      self.assertEqual(len(tuple(cachedir.iterdir())), 0)
+      self.assertEqual(cache._main(['bogus']), 1)
+
+  def test_invalid_codec(self):
+    with self.assertRaises(ValueError), tmpcache(codec='bogus'):
+      pass
+
+  def test_parsesize(self):
+    self.assertEqual(cache._parsesize('100'), 100)
+    self.assertEqual(cache._parsesize('2k'), 2048)
+    self.assertEqual(cache._parsesize('1.5GB'), 3<<29)
+
 class Recursion(TestCase):
 
   def test_nocache(self):
@@ -337,9 +816,14 @@ class Recursion(TestCase):
           cache_files = tuple(cachedir.iterdir())
           self.assertEqual(len(cache_files), 1)
           cache_file, = cache_files
-          self.assertTrue((cache_file/'{:04d}'.format(icorrupted)).exists())
-          with (cache_file/'{:04d}'.format(icorrupted)).open('wb') as f:
+          with (cache_file/'index').open('rb') as f:
+            ends = cache._readindex(f)
+          self.assertEqual(len(ends), 4)
+          with (cache_file/'log').open('r+b') as f:
+            f.seek(ends[icorrupted-1] if icorrupted else 0)
             f.write(corruption.encode())
+            if not corruption:
+              f.truncate()
 
           received_history = untouched
           self.assertEqual(read(R(), 6), tuple(range(6)))
@@ -373,12 +857,12 @@ class Recursion(TestCase):
         self.assertEqual(received_history, ())
         self.assertEqual(nsuccess, 1)
 
-        # Find the cache file of iteration `ilock`, obtain a lock and call
-        # `wrapper` in a thread.  `wrapper` should block on acquiring the file
-        # lock in `function.Recursion`.
+        # Find the lock file, obtain a lock and call `wrapper` in a thread.
+        # `wrapper` should read the cached iterations and block on acquiring the
+        # file lock in `function.Recursion` once the cache is exhausted.
         cache_files = tuple(cachedir.iterdir())
         self.assertEqual(len(cache_files), 1)
-        cache_file = cache_files[0]/'{:04d}'.format(ilock)
+        cache_file = cache_files[0]/'lock'
         assert cache_file.exists()
         with cache_file.open('r+b') as f:
           cache._lock_file(f)
@@ -400,3 +884,28 @@ class Recursion(TestCase):
         self.assertFalse(t.is_alive())
         self.assertEqual(received_history, (3,))
         self.assertEqual(nsuccess, 2)
+
+  @unittest.skipIf(cache._lock_file is cache._lock_file_fallback, 'platform does not support file locks')
+  def test_concurrent_iterators(self):
+
+    class R(cache.Recursion, length=1):
+      def resume(R_self, history):
+        nonlocal ncalls
+        ncalls += 1
+        yield from range(0 if not history else history[-1]+1, 10)
+
+    for writebehind in 0, 2:
+      with self.subTest(writebehind=writebehind), tmpcache(writebehind=writebehind) as cachedir:
+        ncalls = 0
+        a = iter(R())
+        self.assertEqual(next(a), 0)
+        b = iter(R())
+        self.assertEqual([next(b) for i in range(3)], [0, 1, 2]) # must not wait for `a` to complete
+        self.assertEqual([next(a) for i in range(4)], [1, 2, 3, 4])
+        a.close()
+        b.close()
+        self.assertEqual(ncalls, 2)
+        self.assertEqual(tuple(R()), tuple(range(10))) # no duplicate appends
+        self.assertEqual(ncalls, 3)
+        with (cachedir/R().__nutils_hash__.hex()/'index').open('rb') as f:
+          self.assertEqual(len(cache._readindex(f)), 11)
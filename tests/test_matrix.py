@@ -1,4 +1,4 @@
-import numpy, pickle
+import numpy, pickle, unittest.mock
 from nutils import matrix, sparse, testing
 
 class Solver(testing.TestCase):
@@ -138,6 +138,27 @@ class Solver(testing.TestCase):
         res = numpy.linalg.norm(self.matrix @ lhs - rhs, axis=0)
         self.assertLess(numpy.max(res), 1e-9)
 
+  def test_multisolve_rtol(self):
+    rhs = numpy.arange(self.matrix.shape[0])[:,numpy.newaxis] * [1, 1e3, 0] # tolerances differ per column
+    rhsnorm = numpy.linalg.norm(rhs, axis=0)
+    for args in self.args:
+      with self.subTest(args.get('solver', 'direct')):
+        args = dict(args, atol=0., rtol=1e-8)
+        lhs = self.matrix.solve(rhs, **args)
+        res = numpy.linalg.norm(self.matrix @ lhs - rhs, axis=0)
+        self.assertTrue(numpy.less_equal(res, 1e-8 * rhsnorm).all(), res / rhsnorm)
+        self.assertAllEqual(lhs[:,2], 0)
+
+  def test_solve_withinfo(self):
+    rhs = numpy.arange(self.matrix.shape[0])
+    for args in self.args:
+      with self.subTest(args.get('solver', 'direct')):
+        lhs, info = self.matrix.solve_withinfo(rhs, **args)
+        self.assertLess(info.resnorm, args.get('atol', 1e-10))
+        self.assertGreaterEqual(info.time, 0)
+        if 'solver' in args:
+          self.assertGreater(info.niter, 0)
+
   def test_singular(self):
     singularmatrix = matrix.assemble(numpy.arange(self.n)-self.n//2, numpy.arange(self.n)[numpy.newaxis].repeat(2,0), shape=(self.n, self.n))
     rhs = numpy.ones(self.n)
@@ -196,6 +217,74 @@ class Solver(testing.TestCase):
   def test_diagonal(self):
     self.assertAllEqual(self.matrix.diagonal(), numpy.diag(self.exact))
 
+  def test_fingerprints(self):
+    pattern, values = self.matrix.fingerprints
+    self.assertEqual((self.matrix * 2).fingerprints[0], pattern)
+    self.assertNotEqual((self.matrix * 2).fingerprints[1], values)
+    self.assertEqual(matrix.fromsparse(sparse.prune(sparse.fromarray(self.exact), inplace=True)).fingerprints, (pattern, values))
+
+  def test_precon_diag(self):
+    if self.backend == 'numpy':
+      self.skipTest('dense storage of a large diagonal matrix')
+    d = numpy.arange(1, 2**16+1, dtype=float) # exceeds numpy's threshold for eliding temporaries
+    precon = matrix.diag(d).getprecon('diag')
+    for i in range(2): # repeated application must not overwrite the inverse diagonal
+      self.assertAllAlmostEqual(precon(d), numpy.ones_like(d))
+    D = numpy.stack([d, 2*d], axis=1)
+    self.assertAllAlmostEqual(precon(D), numpy.stack([numpy.ones_like(d), 2*numpy.ones_like(d)], axis=1))
+    self.assertAllAlmostEqual(precon(d), numpy.ones_like(d))
+
+  def test_factorcache(self):
+    copy = lambda: matrix.fromsparse(sparse.prune(sparse.fromarray(self.exact), inplace=True))
+    with matrix.factorcache(1):
+      precon = self.matrix.getprecon('diag')
+      self.assertIs(copy().getprecon('diag'), precon)
+      self.assertIsNot((self.matrix * 2).getprecon('diag'), precon)
+      self.assertIsNot(copy().getprecon('diag'), precon) # evicted by the previous line
+    with matrix.factorcache(0):
+      self.assertIsNot(copy().getprecon('diag'), copy().getprecon('diag'))
+      mat = copy()
+      mat.getprecon('diag')
+      self.assertIsNone(mat._fingerprints) # not hashed if reuse is disabled
+    self.assertIsNot(copy().getprecon('diag'), copy().getprecon('diag')) # disabled by default
+    with matrix.factorcache(2):
+      precon = copy().getprecon('diag')
+    self.assertFalse(matrix._base._factorizations) # released on exit
+    with matrix.factorcache(1):
+      mask = numpy.ones(self.n, dtype=bool)
+      mask[0] = False
+      precon = self.matrix.submatrix(mask, mask).getprecon('diag')
+      self.assertIs(self.matrix.submatrix(mask, mask).getprecon('diag'), precon)
+      self.assertIsNot(self.matrix.submatrix(~mask[::-1], ~mask[::-1]).getprecon('diag'), precon) # equal values, different embedding
+
+  def test_multigrid(self):
+    prolongators = []
+    n = self.n
+    while n > 4: # linear interpolation from every other node
+      P = numpy.zeros((n, n//2))
+      P[numpy.arange(1, n, 2), numpy.arange(n//2)] = 1
+      P[numpy.arange(0, n-1, 2), numpy.arange(n//2)] = .5
+      P[numpy.arange(2, n, 2), numpy.arange((n-1)//2)] = .5
+      prolongators.append(matrix.fromsparse(sparse.prune(sparse.fromarray(P), inplace=True)))
+      n //= 2
+    rhs = numpy.ones(self.n)
+    cons = numpy.repeat(numpy.nan, self.n)
+    cons[0] = 10
+    with self.assertRaises(matrix.MatrixError):
+      self.matrix.solve(rhs, solver='cg', precon='multigrid', atol=1e-5)
+    with matrix.multigrid(prolongators), matrix.factorcache(2):
+      for name, constrain in ('free', None), ('constrained', cons):
+        with self.subTest(name):
+          lhs = self.matrix.solve(rhs, constrain=constrain, solver='cg', precon='multigrid', atol=1e-8)
+          res = numpy.linalg.norm((self.matrix @ lhs - rhs)[int(constrain is not None):])
+          self.assertLess(res, 1e-8)
+    with matrix.factorcache(1):
+      with matrix.multigrid(prolongators):
+        precon = (self.matrix * 1).getprecon('multigrid')
+        self.assertIs((self.matrix * 1).getprecon('multigrid'), precon)
+      with matrix.multigrid(prolongators[:1]):
+        self.assertIsNot((self.matrix * 1).getprecon('multigrid'), precon) # different hierarchy
+
 class Numpy(Solver):
   def setUp(self):
     self.backend = 'numpy'
@@ -203,22 +292,107 @@ class Numpy(Solver):
       dict(atol=1e-5, precon='diag', history=5)]
     super().setUp()
 
+class NumpyCSR(Solver):
+  def setUp(self):
+    self.backend = 'numpy:csr'
+    self.args = [{},
+      dict(atol=1e-5, precon='diag', history=5),
+      dict(solver='cg', atol=1e-5),
+      dict(solver='cg', atol=1e-5, precon='diag'),
+      dict(solver='gmres', atol=1e-5),
+      dict(solver='gmres', atol=1e-5, restart=100, precon='diag')]
+    super().setUp()
+
+  def test_storage(self):
+    from nutils.matrix._numpy import CSRMatrix
+    self.assertIsInstance(self.matrix, CSRMatrix)
+    self.assertEqual(len(self.matrix.data), self.n*3-2)
+
+  def test_add_samepattern(self):
+    add = self.matrix + self.matrix * 2
+    self.assertIs(add.indices, self.matrix.indices)
+    numpy.testing.assert_equal(actual=add.export('dense'), desired=self.exact * 3)
+
+  def test_emptyrows(self):
+    mat = matrix.assemble(numpy.array([1.,2.,3.]), numpy.array([[0,2,2],[1,0,2]]), shape=(4,3))
+    self.assertAllEqual(mat @ numpy.array([1.,2.,3.]), [2,0,11,0])
+    self.assertAllEqual(mat.T.export('dense'), [[0,0,2,0],[1,0,0,0],[0,0,3,0]])
+
 class Scipy(Solver):
   def setUp(self):
     self.backend = 'scipy'
     self.args = [{},
+      dict(precon='direct32'),
       dict(atol=1e-5, precon='diag', history=5),
       dict(solver='gmres', atol=1e-5, restart=100, precon='spilu'),
       dict(solver='gmres', atol=1e-5, precon='splu'),
-      dict(solver='cg', atol=1e-5, precon='diag')] + [
+      dict(solver='cg', atol=1e-5, precon='diag'),
+      dict(solver='cg', atol=1e-5, precon='amg')] + [
       dict(solver=s, atol=1e-5) for s in ('bicg', 'bicgstab', 'cg', 'cgs', 'lgmres', 'minres')]
     super().setUp()
 
+  def test_precon_direct32(self):
+    rhs = numpy.arange(self.n, dtype=float)
+    precon = self.matrix.getprecon('direct32')
+    self.assertGreater(numpy.linalg.norm(self.matrix @ precon(rhs) - rhs), 1e-6) # single precision factorization
+    lhs = self.matrix.solve(rhs, precon='direct32')
+    self.assertLess(numpy.linalg.norm(self.matrix @ lhs - rhs), 1e-10)
+
+  def test_monitor(self):
+    matvecs = []
+    class CountingMatrix(type(self.matrix)):
+      def __matmul__(self, other):
+        matvecs.append(other)
+        return super().__matmul__(other)
+    mat = CountingMatrix(self.matrix.core)
+    rhs = numpy.arange(self.n, dtype=float)
+    lhs, info = mat.solve_withinfo(rhs, solver='cg', atol=1e-10, monitor=10)
+    self.assertGreater(info.niter, 10)
+    self.assertEqual(len(matvecs), info.niter // 10 + 1) # sampled residuals and the final residual
+    residuals = []
+    lhs, info = mat.solve_withinfo(rhs, solver='cg', atol=1e-10, callback=residuals.append)
+    self.assertEqual(len(residuals), info.niter)
+
+  def test_gmres_callbacktype(self):
+    # scipy<1.1 has no callback_type argument but reports the residual norm regardless
+    import scipy.sparse.linalg
+    from nutils.matrix import _scipy
+    gmres = scipy.sparse.linalg.gmres
+    residuals = []
+    def oldgmres(A, b, x0=None, tol=1e-5, restart=None, maxiter=None, M=None, callback=None):
+      return gmres(A, b, x0=x0, tol=tol, restart=restart, maxiter=maxiter, M=M, callback=callback, callback_type='legacy')
+    self.enter_context(unittest.mock.patch.object(_scipy, '_gmrescallbacktype', False))
+    self.enter_context(unittest.mock.patch.object(scipy.sparse.linalg, 'gmres', oldgmres))
+    rhs = numpy.arange(self.n, dtype=float)
+    lhs = self.matrix.solve(rhs, solver='gmres', atol=1e-5, restart=100, callback=residuals.append)
+    self.assertLess(numpy.linalg.norm(self.matrix @ lhs - rhs), 1e-5)
+    self.assertTrue(residuals)
+
+  def test_amg(self):
+    n = 40
+    laplace = numpy.kron(self.exact[:n,:n], numpy.eye(n)) + numpy.kron(numpy.eye(n), self.exact[:n,:n])
+    mat = matrix.fromsparse(sparse.prune(sparse.fromarray(laplace), inplace=True))
+    rhs = numpy.ones(n**2)
+    with matrix.factorcache(0):
+      (mat * 1).solve(rhs, solver='cg', precon='amg', atol=1e-8)
+      self.assertFalse(matrix._base._analyses) # not retained if reuse is disabled
+    with matrix.factorcache(1):
+      residuals = []
+      lhs = mat.solve(rhs, solver='cg', precon='amg', atol=1e-8, callback=residuals.append)
+      self.assertLess(numpy.linalg.norm(mat @ lhs - rhs), 1e-8)
+      self.assertLess(len(residuals), 20)
+      aggregates = mat._getanalysis('amg')
+      self.assertGreater(len(aggregates), 0)
+      lhs = (mat * 2).solve(rhs, solver='cg', precon='amg', atol=1e-8)
+      self.assertLess(numpy.linalg.norm(mat @ lhs * 2 - rhs), 1e-8)
+      self.assertIs(mat._getanalysis('amg'), aggregates)
+
 @testing.parametrize
 class MKL(Solver):
   def setUp(self):
     self.backend = 'mkl:' + self.threading
     self.args=[{},
+      dict(precon='direct32'),
       dict(atol=1e-5, precon='diag', history=5),
       dict(solver='fgmres', atol=1e-8),
       dict(solver='fgmres', atol=1e-8, precon='diag')]
@@ -1,4 +1,4 @@
-import unittest, os, multiprocessing, time, sys
+import unittest, os, multiprocessing, time, sys, treelog, re
 from nutils import parallel, testing
 
 canfork = hasattr(os, 'fork')
@@ -15,6 +15,36 @@ class Test(testing.TestCase):
       self.assertEqual(parallel._maxprocs.value, 4)
     self.assertEqual(parallel._maxprocs.value, 3)
 
+  def test_threadpolicy(self):
+    with parallel.threadpolicy('single'):
+      self.assertEqual(parallel._threadpolicy.value, 'single')
+    self.assertEqual(parallel._threadpolicy.value, 'divide')
+    with self.assertRaises(ValueError):
+      parallel.threadpolicy('invalid')
+
+  def test_numthreads(self):
+    a = parallel.shzeros([3], dtype=int)
+    with parallel.threadpolicy('single'), parallel.fork() as procid:
+      a[procid] = max([getter() for getter, setter in parallel._threadpools()], default=1)
+    self.assertEqual(a.tolist(), [1,1,1] if canfork else [1,0,0])
+
+  def test_threadpools_cached(self):
+    threadpools = parallel._threadpools()
+    self.assertIs(parallel._threadpools(), threadpools)
+    with parallel.threadpolicy('divide'), parallel.fork() as procid:
+      pass
+    self.assertIs(parallel._threadpools(), threadpools)
+
+  @unittest.skipIf(not hasattr(os, 'sched_setaffinity'), 'pinning is not available on this system')
+  def test_pinning(self):
+    cpus = os.sched_getaffinity(0)
+    a = parallel.shzeros([3], dtype=int)
+    with parallel.pinning(True), parallel.fork() as procid:
+      mycpus = os.sched_getaffinity(0)
+      a[procid] = len(mycpus) if mycpus <= cpus else -1
+    self.assertEqual(os.sched_getaffinity(0), cpus)
+    self.assertEqual(a.tolist(), [max(len(cpus)*(i+1)//3 - len(cpus)*i//3, 1) for i in range(3)] if canfork else [len(cpus),0,0])
+
   def test_fork(self):
     mask = multiprocessing.RawValue('i', 0)
     lock = multiprocessing.Lock()
@@ -35,9 +65,30 @@ class Test(testing.TestCase):
 
   @unittest.skipIf(not canfork, 'fork is not available on this system')
   def test_failinchild(self):
-    with self.assertRaisesRegex(Exception, 'fork failed in 2 out of 3 processes'), parallel.fork() as procid:
+    with self.assertRaises(ZeroDivisionError) as cm, parallel.fork() as procid:
       if procid != 0:
         1/0
+    self.assertRegex(str(cm.exception.__cause__), '^traceback in process 1:\n(.|\n)*ZeroDivisionError: division by zero$')
+
+  @unittest.skipIf(not canfork, 'fork is not available on this system')
+  def test_failinchild_unpicklable(self):
+    with self.assertRaisesRegex(Exception, 'fork failed in 1 out of 3 processes') as cm, parallel.fork() as procid:
+      if procid == 2:
+        e = Exception('unpicklable')
+        e.data = lambda: None
+        raise e
+    self.assertRegex(str(cm.exception.__cause__), '^traceback in process 2:\n(.|\n)*Exception: unpicklable$')
+
+  @unittest.skipIf(not canfork, 'fork is not available on this system')
+  def test_failinchild_ctxrange(self):
+    mainpid = os.getpid()
+    with self.assertRaisesRegex(ValueError, '^item [0-9]+$') as cm, parallel.ctxrange('test', 32) as r:
+      for i in r:
+        time.sleep(.01)
+        if os.getpid() != mainpid:
+          raise ValueError('item {}'.format(i))
+    item = str(cm.exception).split()[1]
+    self.assertRegex(str(cm.exception.__cause__), '^traceback in process [12] while processing item {}:\n'.format(item))
 
   def test_range(self):
     a = parallel.shempty([32], dtype=int)
@@ -57,3 +108,17 @@ class Test(testing.TestCase):
         a[i] = 1
         time.sleep(.01)
     self.assertEqual(a.tolist(), [1]*len(a))
+
+  @unittest.skipIf(not canfork, 'fork is not available on this system')
+  def test_ctxrange_report(self):
+    recordlog = treelog.RecordLog()
+    with treelog.set(recordlog), parallel.ctxrange('test', 32) as r:
+      for i in r:
+        time.sleep(.01)
+    messages = [args for cmd, *args in recordlog._messages if cmd == 'write']
+    self.assertEqual(len(messages), 1)
+    text, level = messages[0]
+    self.assertEqual(level, treelog.proto.Level.debug)
+    self.assertRegex(text, '^test completed by 3 processes in .*; items min/max/mean [0-9]+/[0-9]+/10.7; .* efficiency [0-9]+%$')
+    idle = [float(v) for v in re.search('idle min/max/mean ([0-9.]+)/([0-9.]+)/([0-9.]+)s', text).groups()]
+    self.assertLess(idle[0], .1) # the last process to complete hardly waits
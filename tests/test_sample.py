@@ -48,6 +48,47 @@ class rectilinear(TestCase):
     arg = function.Argument('dofs', [2,3])
     self.assertTrue(function.iszero(function.derivative(sampled, arg)))
 
+@parametrize
+class eval(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.enter_context(parallel.maxprocs(self.nprocs))
+    self.domain, self.geom = mesh.rectilinear([4,3])
+    self.gauss = self.domain.sample('gauss', 2)
+    self.basis = self.domain.basis('std', degree=1)
+
+  def test_default(self):
+    values = self.gauss.eval(self.basis)
+    self.assertEqual(values.shape, (self.gauss.npoints, len(self.basis)))
+    self.assertAllAlmostEqual(values.sum(1), numpy.ones(self.gauss.npoints), places=15)
+
+  def test_disjoint(self):
+    index = [self.gauss.getindex(ielem)[::-1] for ielem in range(self.gauss.nelems)][::-1]
+    custom = sample.Sample.new(self.gauss.transforms, self.gauss.points, index)
+    self.assertAllAlmostEqual(custom.eval(self.geom)[numpy.concatenate(index)], self.gauss.eval(self.geom), places=15)
+
+  def test_overlapping(self):
+    index = [numpy.arange(points.npoints) for points in self.gauss.points]
+    custom = sample.Sample.new(self.gauss.transforms, self.gauss.points, index)
+    values = custom.eval(self.geom)
+    self.assertAllAlmostEqual(values[:4], self.gauss.eval(self.geom).reshape(self.gauss.nelems, 4, 2).sum(0), places=12)
+    self.assertAllEqual(values[4:], 0)
+
+  def test_overlapping_multiple(self):
+    index = [numpy.arange(points.npoints) for points in self.gauss.points]
+    custom = sample.Sample.new(self.gauss.transforms, self.gauss.points, index)
+    values, values0 = custom.eval([self.geom, self.geom[0]])
+    expected = self.gauss.eval(self.geom).reshape(self.gauss.nelems, 4, 2).sum(0)
+    self.assertAllAlmostEqual(values[:4], expected, places=12)
+    self.assertAllAlmostEqual(values0[:4], expected[:,0], places=12)
+    self.assertAllEqual(values[4:], 0)
+    self.assertAllEqual(values0[4:], 0)
+
+eval(nprocs=1)
+eval(nprocs=2)
+eval(nprocs=3)
+
 class integral(TestCase):
 
   def setUp(self):
@@ -88,3 +129,70 @@ class integral(TestCase):
     array = empty.eval().export('dense')
     self.assertEqual(array.shape, shape)
     self.assertAllEqual(array.flat, 0)
+
+class operator(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.ns = function.Namespace()
+    self.topo, self.ns.x = mesh.rectilinear([4,3])
+    self.ns.basis = self.topo.basis('std', degree=1)
+    self.ns.u = 'basis_n ?lhs_n'
+    self.residual = self.topo.integral('(basis_n,i u_,i (1 + u^2) + basis_n) d:x' @ self.ns, degree=4)
+    self.lhs = numpy.sin(numpy.arange(len(self.ns.basis)))
+    self.jacobian = self.residual.derivative('lhs')
+    self.matrix = self.jacobian.eval(lhs=self.lhs)
+    self.operator = self.jacobian.operator(lhs=self.lhs)
+    self.cons = numpy.zeros(len(self.lhs), dtype=bool)
+    self.cons[::7] = True
+
+  def test_matvec(self):
+    v = numpy.cos(numpy.arange(len(self.lhs)))
+    self.assertAllAlmostEqual(self.operator @ v, self.matrix @ v, places=12)
+    V = numpy.stack([v, v**2], axis=1)
+    self.assertAllAlmostEqual(self.operator @ V, self.matrix @ V, places=12)
+
+  def test_diagonal(self):
+    self.assertAllAlmostEqual(self.operator.diagonal(), self.matrix.diagonal(), places=12)
+
+  def test_transpose(self):
+    v = numpy.cos(numpy.arange(len(self.lhs)))
+    self.assertAllAlmostEqual(self.operator.T @ v, self.matrix.T @ v, places=12)
+
+  def test_arithmetic(self):
+    v = numpy.cos(numpy.arange(len(self.lhs)))
+    self.assertAllAlmostEqual((self.operator * 2 - self.operator) @ v, self.matrix @ v, places=12)
+
+  def test_submatrix(self):
+    v = numpy.cos(numpy.arange((~self.cons).sum()))
+    sub = self.operator.submatrix(~self.cons, ~self.cons)
+    self.assertAllAlmostEqual(sub @ v, self.matrix.submatrix(~self.cons, ~self.cons) @ v, places=12)
+    self.assertAllAlmostEqual(sub.diagonal(), self.matrix.diagonal()[~self.cons], places=12)
+    self.assertAllAlmostEqual(sub.export('dense'), self.matrix.submatrix(~self.cons, ~self.cons).export('dense'), places=12)
+
+  def test_solve_gmres(self):
+    rhs = numpy.ones(len(self.lhs))
+    x = self.operator.solve(rhs, constrain=self.cons, solver='gmres', precon='diag', atol=1e-10)
+    self.assertAllEqual(x[self.cons], 0)
+    self.assertLess(numpy.linalg.norm((self.matrix @ x - rhs)[~self.cons]), 1e-10)
+
+  def test_solve_cg(self):
+    laplace = self.topo.integral(self.ns.eval_nm('basis_n,i basis_m,i d:x'), degree=2)
+    rhs = numpy.ones(len(self.lhs))
+    x = laplace.operator().solve(rhs, constrain=self.cons, solver='cg', precon='diag', atol=1e-10)
+    self.assertAllEqual(x[self.cons], 0)
+    self.assertLess(numpy.linalg.norm((laplace.eval() @ x - rhs)[~self.cons]), 1e-10)
+
+  def test_solve_scipy(self):
+    try:
+      import scipy.sparse.linalg
+    except ImportError:
+      self.skipTest('scipy is not installed')
+    self.assertIsInstance(self.operator.linearoperator, scipy.sparse.linalg.LinearOperator)
+    self.assertEqual(self.operator.linearoperator.shape, self.operator.shape)
+    rhs = numpy.ones(len(self.lhs))
+    with self.assertLogs('nutils', 'INFO') as cm:
+      x = self.operator.solve(rhs, constrain=self.cons, solver='bicgstab', precon='diag', atol=1e-10)
+    self.assertIn('using scipy solver', '\n'.join(cm.output))
+    self.assertAllEqual(x[self.cons], 0)
+    self.assertLess(numpy.linalg.norm((self.matrix @ x - rhs)[~self.cons]), 1e-10)
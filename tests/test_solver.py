@@ -1,6 +1,6 @@
-from nutils import solver, mesh, function, cache, types, numeric, warnings
+from nutils import solver, mesh, function, cache, types, numeric, warnings, sample
 from nutils.testing import *
-import numpy, contextlib, tempfile, itertools, logging
+import numpy, contextlib, tempfile, itertools, logging, unittest.mock
 
 @contextlib.contextmanager
 def tmpcache():
@@ -90,6 +90,12 @@ class navierstokes(TestCase):
   def test_newton_iter(self):
     _test_recursion_cache(self, lambda: ((types.frozenarray(lhs), info.resnorm) for lhs, info in solver.newton('dofs', residual=self.residual, constrain=self.cons)))
 
+  def test_newton_jacreuse(self):
+    self.assert_resnorm(solver.newton('dofs', residual=self.residual, lhs0=self.lhs0, constrain=self.cons, jacreuse=3).solve(tol=self.tol, maxiter=6))
+
+  def test_newton_jacreuse_iter(self):
+    _test_recursion_cache(self, lambda: ((types.frozenarray(lhs), info.resnorm, info.jacage) for lhs, info in solver.newton('dofs', residual=self.residual, lhs0=self.lhs0, constrain=self.cons, jacreuse=3)))
+
   def test_pseudotime(self):
     self.assert_resnorm(solver.pseudotime('dofs', residual=self.residual, lhs0=self.lhs0, constrain=self.cons, inertia=self.inertia, timestep=1).solve(tol=self.tol, maxiter=12))
 
@@ -127,6 +133,9 @@ class finitestrain(TestCase):
   def test_newton_boolcons(self):
     self.assert_resnorm(solver.newton('dofs', residual=self.residual, constrain=self.boolcons).solve(tol=self.tol, maxiter=7))
 
+  def test_newton_jacreuse(self):
+    self.assert_resnorm(solver.newton('dofs', residual=self.residual, constrain=self.cons, jacreuse=2).solve(tol=self.tol, maxiter=12))
+
   def test_newton_iter(self):
     _test_recursion_cache(self, lambda: ((types.frozenarray(lhs), info.resnorm) for lhs, info in solver.newton('dofs', residual=self.residual, constrain=self.cons)))
 
@@ -140,6 +149,58 @@ class finitestrain(TestCase):
     _test_recursion_cache(self, lambda: ((types.frozenarray(lhs), info.resnorm) for lhs, info in solver.minimize('dofs', energy=self.energy, constrain=self.cons)))
 
 
+class newton_jacreuse(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    ns = function.Namespace()
+    domain, ns.x = mesh.rectilinear([numpy.linspace(0,1,5)])
+    ns.basis = domain.basis('std', degree=1)
+    ns.u = 'basis_n ?dofs_n'
+    self.residual = domain.integral('(basis_n,i u_,i + basis_n (u + .5 u^3 - 1)) d:x' @ ns, degree=4)
+
+  def iterate(self, n, **kwargs):
+    return [(numpy.array(lhs), info) for (lhs, info), i in zip(solver.newton('dofs', residual=self.residual, **kwargs), range(n))]
+
+  def test_reuse(self):
+    history = self.iterate(8, jacreuse=2, reuserate=.5)
+    ages = [info.jacage for lhs, info in history]
+    self.assertEqual(ages, [0, 1, 1, 2, 3, 1, 2, 3])
+    for i, (lhs, info) in enumerate(history):
+      with self.subTest(i=i):
+        self.assertAllEqual(info.jaclhs, history[i-info.jacage][0]) # jacobian of the iterate jacage updates back
+        if i:
+          self.assertLessEqual(info.resnorm, .5 * history[i-1][1].resnorm)
+    self.assertLess(history[-1][1].resnorm, 1e-10)
+
+  def test_fallback(self):
+    history = self.iterate(8, jacreuse=2, reuserate=.5)
+    # the second update failed with the jacobian of the initial vector and was
+    # retried with a new jacobian, which is then reused
+    self.assertEqual(history[2][1].jacage, 1)
+    self.assertAllEqual(history[2][1].jaclhs, history[1][0])
+
+  def test_fallback_linesearch(self):
+    # a full update with a new jacobian that does not reduce the residual
+    # sufficiently falls back on the line search, which should not evaluate the
+    # residual at the same vector again
+    newton = solver.newton('dofs', residual=self.residual, jacreuse=5, reuserate=.1)
+    it = iter(newton)
+    next(it)
+    evaluated = []
+    eval_integrals_sparse = sample.eval_integrals_sparse
+    def counting(*integrals, **arguments):
+      evaluated.extend(integral is newton.residual for integral in integrals)
+      return eval_integrals_sparse(*integrals, **arguments)
+    with unittest.mock.patch.object(sample, 'eval_integrals_sparse', counting):
+      lhs, info = next(it)
+    self.assertEqual(info.jacage, 0)
+    self.assertEqual(sum(evaluated), 1)
+
+  def test_resume(self):
+    _test_recursion_cache(self, lambda: ((types.frozenarray(lhs), info.resnorm, info.jacage, types.frozenarray(info.jaclhs)) for lhs, info in solver.newton('dofs', residual=self.residual, jacreuse=2, reuserate=.5)))
+
+
 class optimize(TestCase):
 
   def setUp(self):
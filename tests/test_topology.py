@@ -306,6 +306,33 @@ for etype in _refined_refs:
         refined(etype=etype, ref0=ref0, ref1=ref1, ref2=ref2)
 
 
+@parametrize
+class prolongation(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.topo, geom = mesh.unitsquare(2, self.etype) if self.etype != 'rectilinear' else mesh.rectilinear([3,2])
+    self.coarse = self.topo.basis(self.btype, degree=self.degree)
+    self.finetopo = self.topo.refined_by([0]) if 'h-' in self.btype else self.topo.refined
+    self.fine = self.finetopo.basis(self.btype, degree=self.degree)
+
+  def test_exact(self):
+    P = self.finetopo.prolongation(self.coarse, self.fine, degree=2*self.degree)
+    self.assertEqual(P.shape, (len(self.fine), len(self.coarse)))
+    fine, coarse = self.finetopo.sample('bezier', 3).eval([self.fine, self.coarse])
+    self.assertAllAlmostEqual(fine @ P.export('dense'), coarse)
+
+  def test_notnested(self):
+    with self.assertRaises(ValueError):
+      self.finetopo.prolongation(self.topo.basis(self.btype, degree=self.degree+1), self.fine, degree=2*self.degree+2)
+
+prolongation('std1', etype='rectilinear', btype='std', degree=1)
+prolongation('std2', etype='rectilinear', btype='std', degree=2)
+prolongation('spline2', etype='rectilinear', btype='spline', degree=2)
+prolongation('triangle', etype='triangle', btype='std', degree=1)
+prolongation('hierarchical', etype='square', btype='th-std', degree=1)
+
+
 @parametrize
 class general(TestCase):
 
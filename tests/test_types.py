@@ -1,6 +1,6 @@
 from nutils.testing import *
 import nutils.types
-import inspect, pickle, itertools, ctypes, stringly, tempfile, io, os
+import inspect, pickle, itertools, ctypes, stringly, tempfile, io, os, gc
 import numpy
 
 class apply_annotations(TestCase):
@@ -88,6 +88,30 @@ class apply_annotations(TestCase):
     self.assertEqual(f(None), None)
     self.assertEqual(f(1), '1')
 
+  def test_canonical_type(self):
+    calls = []
+    def ann(value):
+      calls.append(value)
+      return int(value)
+    ann.canonical_type = int
+    @nutils.types.apply_annotations
+    def f(a:ann, b:ann=None):
+      return a, b
+    self.assertEqual(f(1), (1, None))
+    self.assertEqual(calls, [])
+    self.assertEqual(f(True, 2.), (1, 2))
+    self.assertEqual(calls, [True, 2.])
+
+  def test_canonical_tuple(self):
+    @nutils.types.apply_annotations
+    def f(a:nutils.types.tuple[nutils.types.strictint], b:nutils.types.frozenarray):
+      return a, b
+    a = 1, 2
+    b = nutils.types.frozenarray([1, 2])
+    self.assertIs(f(a, b)[0], a)
+    self.assertIs(f(a, b)[1], b)
+    self.assertEqual(f((True, numpy.int64(2)), [1, 2]), (a, b))
+
 class nutils_hash(TestCase):
 
   class custom:
@@ -871,6 +895,17 @@ class frozenarray(TestCase):
     a = numpy.array(nutils.types.frozenarray([1,2]))
     self.assertIsInstance(a, numpy.ndarray)
 
+  def test_nutils_hash(self):
+    a = nutils.types.frozenarray(numpy.arange(6.).reshape(2,3))
+    self.assertEqual(nutils.types.nutils_hash(a).hex(), 'b9adbf4d1e0754d0d0711fe495b70463f5cf3a3a')
+
+  def test_nutils_hash_strided(self):
+    chunksize = nutils.types._hashchunksize
+    nutils.types._hashchunksize = 16
+    self.addCleanup(setattr, nutils.types, '_hashchunksize', chunksize)
+    a = numpy.arange(60.).reshape(5,12)[::2,::3]
+    self.assertEqual(nutils.types.nutils_hash(nutils.types.frozenarray(a, copy=False)), nutils.types.nutils_hash(nutils.types.frozenarray(a.copy())))
+
 class c_array(TestCase):
 
   def test_idempotence(self):
@@ -1008,6 +1043,32 @@ class ImmutableFamily(TestCase):
 ImmutableFamily(cls=nutils.types.Immutable)
 ImmutableFamily(cls=nutils.types.Singleton)
 
+class Singleton(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    class T(nutils.types.Singleton):
+      def __init__(self, x):
+        pass
+    self.T = T
+    self.name = T.__module__ + '.' + T.__qualname__
+
+  def test_weak(self):
+    a = self.T(1)
+    b = self.T(2)
+    self.assertEqual(len(self.T._cache), 2)
+    del b
+    gc.collect()
+    self.assertEqual(len(self.T._cache), 1)
+    self.assertIs(self.T(1), a)
+
+  def test_singletons(self):
+    a = self.T(1)
+    b = self.T(nutils.types.frozenarray(numpy.zeros(1000)))
+    count, size = nutils.types.singletons()[self.name]
+    self.assertEqual(count, 2)
+    self.assertGreater(size, 8000)
+
 class Unit(TestCase):
 
   def setUp(self):